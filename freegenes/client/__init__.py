@@ -39,6 +39,20 @@ def get_parser():
     subparsers.add_parser("shell", help="Interact with freegenes python")
     subparsers.add_parser("twist", help="Interact with twist API")
 
+    mirror = subparsers.add_parser("mirror", help="Mirror the database to local sqlite")
+
+    mirror.add_argument('output', nargs='?', default='freegenes.db',
+                        help="the sqlite database to write (default freegenes.db)")
+
+    mirror.add_argument('--entity', dest="entities", action='append', default=None,
+                        help="an entity to mirror (e.g., parts), can be repeated (default all)")
+
+    mirror.add_argument('--workers', dest="workers", type=int, default=8,
+                        help="the number of concurrent downloads (default 8)")
+
+    mirror.add_argument('--full', dest="full", default=False, action='store_true',
+                        help="download all records, instead of only modified ones")
+
     return parser
 
 
@@ -107,6 +121,8 @@ def main():
         from .shell import main as func
     elif args.command == 'twist': 
         from .twist import main as func
+    elif args.command == 'mirror':
+        from .mirror import main as func
     else:
         print_help()
 
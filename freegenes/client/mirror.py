@@ -0,0 +1,25 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.main import Client
+from freegenes.logger import bot
+
+
+def main(args, options, parser):
+
+    client = Client(workers=args.workers)
+    counts = client.mirror(args.output,
+                           entities=args.entities,
+                           workers=args.workers,
+                           full=args.full)
+
+    for entity, count in counts.items():
+        bot.info("%s: %s records retrieved" %(entity, count))
+    bot.info("Mirror saved to %s" % args.output)
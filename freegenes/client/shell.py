@@ -19,8 +19,8 @@ def main(args, options, parser):
 
     shells = ['ipython', 'python', 'bpython']
 
-    # Prepare client
-    client = Client()
+    # Prepare client, the token is tested with the first request
+    client = Client(lazy=True)
 
     # Otherwise present order of liklihood to have on system
     for shell in shells:
@@ -10,24 +10,79 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from freegenes.version import __version__
 from freegenes.logger import bot
+from freegenes.logger.message import convert2boolean
+
+from .helpers import (
+    derive_parts,
+    derive_parts_batch,
+    get_derived,
+    save_derived
+)
+from .cache import (
+    cache_parts,
+    check_parts_store,
+    get_modified,
+    get_parts_details,
+    get_parts_records,
+    get_parts_store,
+    refresh_parts_cache
+)
+from .bulk import (
+    bulk_functions,
+    composite_bulk_functions,
+    create_entities,
+    get_composite_data,
+    patch_entities,
+    run_bulk,
+    run_bulk_data,
+    update_entities
+)
+from .entities import ENTITIES
+from .index import get_parts_index
+from .pagination import get_pages, get_page, iter_pages
+from .loader import Loader
+from .mirror import Mirror, get_mirrored, mirror, mirror_entity
+from .records import to_records
+from .responses import ResponseCache, get_url_entity
+from .session import Session
 
-from .helpers import derive_parts
-from .cache import cache_parts
-
-import requests
 import os
 import re
+import requests
+import threading
+
+# Tokens (by base) validated by any client in this process
+VALIDATED = set()
+VALIDATED_LOCK = threading.Lock()
 
 class Client(object):
 
-    def __init__(self, token=None, base="https://freegenes.dev", validate=True):
+    def __init__(self, token=None, base="https://freegenes.dev", validate=True, workers=8,
+                       cache_dir=None, pool_size=None, retries=3, keep_alive=True,
+                       rate=None, response_cache=None, records=False, lazy=False,
+                       offline=False, snapshot=None):
  
         self.validate = validate
+        self.records = records
+        self.workers = workers
+        self._set_offline(offline)
+        self.session = Session(pool_size=pool_size or max(workers, 10),
+                               retries=retries,
+                               keep_alive=keep_alive,
+                               rate=rate)
         self._set_base(base)
         self._set_token(token)
         self._set_headers()
-        self._test_token()
+        self._set_cache_dir(cache_dir)
+        self._set_snapshot(snapshot)
+        self._validated = not validate or self.offline
+        if not lazy:
+            self._test_token()
         self.cache = {}
+        self._parts_index = None
+        self._parts_store = None
+        self._set_response_cache(response_cache)
+        self.loader = Loader(self)
 
     def __repr__(self):
         return "[client][freegenes][%s]" % __version__
@@ -39,7 +94,7 @@ class Client(object):
         '''ensure that token provided, or FREEGENES_TOKEN is defined in environ
         '''
         self.token = os.environ.get('FREEGENES_TOKEN', token)
-        if not self.token:
+        if not self.token and not self.offline:
             if self.validate:
                 bot.exit("You must provide a token or export FREEGENES_TOKEN.")
             bot.warning("No token provided, API will not function as expected.")
@@ -51,6 +106,40 @@ class Client(object):
         if self.base:
             self.base = self.base.strip('/')
 
+    def _set_cache_dir(self, cache_dir):
+        '''look for FREEGENES_CACHE defined in environ, a directory to
+           persist the parts cache between clients (not used if unset).
+        '''
+        self.cache_dir = os.environ.get('FREEGENES_CACHE', cache_dir)
+
+    def _set_offline(self, offline):
+        '''look for FREEGENES_OFFLINE defined in environ. An offline client
+           doesn't make requests, and only reads from local caches (the
+           parts store, the response cache, and a mirror).
+        '''
+        self.offline = convert2boolean(os.environ.get('FREEGENES_OFFLINE', offline))
+
+    def _set_snapshot(self, snapshot):
+        '''look for FREEGENES_MIRROR defined in environ, the path to a mirror
+           of the database (see mirror) to read from when offline.
+        '''
+        path = os.environ.get('FREEGENES_MIRROR', snapshot)
+        self.snapshot = None
+        if path and not os.path.exists(path):
+            bot.warning("Mirror %s does not exist, create it with mirror." % path)
+        elif path:
+            self.snapshot = Mirror(path)
+
+    def _set_response_cache(self, response_cache):
+        '''set the cache for get responses, None (or False) to not cache,
+           True for a ResponseCache with defaults, or a ResponseCache.
+        '''
+        if response_cache is True:
+            response_cache = ResponseCache()
+        elif response_cache is False:
+            response_cache = None
+        self.response_cache = response_cache
+
     def _set_headers(self):
         '''set the headers to the default, meaning we provide an
            authorization token.
@@ -71,15 +160,30 @@ class Client(object):
 
     def _test_token(self):
         '''test that the token works - this function also ensures
-           that the base is correct.
+           that the base is correct. A token is only tested once for
+           a base in a process, even with several clients.
         '''
-        if self.validate:
-            if requests.head("%s" % self.base, headers=self.headers).status_code != 200:
-                bot.exit('Provided token is invalid.')
+        with VALIDATED_LOCK:
+            if self._validated:
+                return
+            if (self.base, self.token) not in VALIDATED:
+                if self.session.head("%s" % self.base, headers=self.headers).status_code != 200:
+                    bot.exit('Provided token is invalid.')
+                VALIDATED.add((self.base, self.token))
+            self._validated = True
+
+    def _check_request(self, url):
+        '''check that the client can make a request (it's not offline), and
+           test the token before the first request if it wasn't (lazy).
+        '''
+        if self.offline:
+            bot.exit("The client is offline and %s is not cached." % url)
+        if not self._validated:
+            self._test_token()
 
     # Specific API calls
 
-    def get(self, url, headers=None, paginate=True, limit=1000):
+    def get(self, url, headers=None, paginate=True, limit=1000, cache=True):
         '''the default get, will use default headers if custom aren't defined.
            we take a partial url (e.g., /api/authors) and then add the base.
 
@@ -87,8 +191,10 @@ class Client(object):
            ==========
            url: the url endpoint to query (without the http/s or domain)
            headers: if defined, don't use default headers.
-           paginate: obtain all pages after query (default is True)
+           paginate: obtain all pages after query (default is True), pages
+                     after the first are retrieved concurrently
            limit: number of responses per query (default 1000)
+           cache: use the response cache, if the client has one
         '''
         heads = headers or self.headers
 
@@ -97,7 +203,35 @@ class Client(object):
         if url.startswith('http'):
             fullurl = url
 
-        response = requests.get(fullurl, headers=heads)
+        # Responses are only cached for the default headers
+        key = None
+        results = None
+        if cache and self.response_cache is not None and headers is None:
+            key = (fullurl, paginate)
+            results = self.response_cache.get(key)
+
+        # An offline client can read from a mirror
+        if results is None and self.offline:
+            results = self._get_mirrored(fullurl)
+
+        if results is None:
+            results = self._get(fullurl, heads, paginate)
+            if isinstance(results, requests.Response):
+                return results
+            if key is not None:
+                self.response_cache.set(key, get_url_entity(fullurl), results)
+
+        # Return compact records instead of dictionaries
+        if self.records:
+            results = self.loader.bind(to_records(results, get_url_entity(fullurl)))
+        return results
+
+    def _get(self, fullurl, heads, paginate=True):
+        '''perform the get for a complete url (see get), returning the
+           results or the response if it wasn't successful.
+        '''
+        self._check_request(fullurl)
+        response = self.session.get(fullurl, headers=heads)
 
         # Return a successful response
         if response.status_code == 200:
@@ -110,29 +244,27 @@ class Client(object):
                 results = response['results']
 
             # Are there pages (but the user doesn't want a specific one)
-            if paginate:
-                next_url = response.get('next')
-                if next_url is not None:
-                    return results + self.get(next_url, headers)
+            if paginate and "results" in response and response.get('next'):
+                return self._get_pages(response, heads, results)
             return results
 
-        bot.error("Error with %s, return value %s: %s" %(url, response.status_code, response.reason))
+        bot.error("Error with %s, return value %s: %s" %(fullurl, response.status_code, response.reason))
         return response
 
     def patch(self, url, data, headers=None):
         '''a patch request is used for a partial update.
         '''
-        return self._create(url, requests.patch, data, headers, "patch")
+        return self._create(url, self.session.patch, data, headers, "patch")
 
     def post(self, url, data=None, headers=None):
-        '''a wrapper to create, providing requests.post as the function
+        '''a wrapper to create, providing session.post as the function
         '''
-        return self._create(url, requests.post, data, headers)
+        return self._create(url, self.session.post, data, headers)
 
     def put(self, url, data=None, headers=None):
-        '''a wrapper to create, providing requests.put as the function
+        '''a wrapper to create, providing session.put as the function
         '''
-        return self._create(url, requests.put, data, headers)
+        return self._create(url, self.session.put, data, headers)
 
     def _create(self, url, func, data=None, headers=None, name="create"):
         '''create is a base method that can handle a put or post, and
@@ -159,7 +291,9 @@ class Client(object):
         if not data:
             bot.exit("At least one parameter must be provided for a %s" % name)
 
+        self._check_request(fullurl)
         response = func(fullurl, headers=heads, data=data)
+        self._invalidate_cached(fullurl)
 
         # Return a successful response
         if response.status_code in [200, 201]: 
@@ -180,13 +314,24 @@ class Client(object):
         '''
         heads = headers or self.headers
         fullurl = self._prepare_url(url)
-        response = requests.delete(fullurl, headers=heads)
+        self._check_request(fullurl)
+        response = self.session.delete(fullurl, headers=heads)
+        self._invalidate_cached(fullurl)
 
         if response.status_code not in [204]: 
             bot.error("Error with %s, return value %s: %s" %(url, response.status_code, response.reason))
 
         return response
 
+    def _invalidate_cached(self, url):
+        '''after a write to an entity, remove its cached responses and
+           loaded records.
+        '''
+        entity = get_url_entity(url)
+        if self.response_cache is not None:
+            self.response_cache.invalidate(entity)
+        self.loader.clear(entity)
+
     def create_entity(self, name, data=None):
         '''create an entity with a POST request.
 
@@ -425,6 +570,84 @@ class Client(object):
         return self.get_entity('tags', uuid)
 
 
+    # ITER Endpoints (streaming listings)
+
+    def iter_entity(self, name, limit=1000, prefetch=True):
+        '''yield the entities of a listing one at a time, retrieving one
+           page at a time (and the next page in the background if prefetch
+           is True) so the entire listing is never held in memory. With
+           records, each page is bound to the loader (as a batch).
+
+           Parameters
+           ==========
+           name: the name of the endpoint to list
+           limit: number of responses per page (default 1000)
+           prefetch: retrieve the next page while yielding the current
+        '''
+        for page in self._iter_pages('/api/%s/' % name, limit=limit, prefetch=prefetch):
+            if self.records:
+                page = self.loader.bind(to_records(page, name))
+            for entity in page:
+                yield entity
+
+    def iter_authors(self, prefetch=True):
+        return self.iter_entity('authors', prefetch=prefetch)
+
+    def iter_collections(self, prefetch=True):
+        return self.iter_entity('collections', prefetch=prefetch)
+
+    def iter_composite_parts(self, prefetch=True):
+        return self.iter_entity('compositeparts', prefetch=prefetch)
+
+    def iter_containers(self, prefetch=True):
+        return self.iter_entity('containers', prefetch=prefetch)
+
+    def iter_distributions(self, prefetch=True):
+        return self.iter_entity('distributions', prefetch=prefetch)
+
+    def iter_institutions(self, prefetch=True):
+        return self.iter_entity('institutions', prefetch=prefetch)
+
+    def iter_modules(self, prefetch=True):
+        return self.iter_entity('modules', prefetch=prefetch)
+
+    def iter_operations(self, prefetch=True):
+        return self.iter_entity('operations', prefetch=prefetch)
+
+    def iter_orders(self, prefetch=True):
+        return self.iter_entity('orders', prefetch=prefetch)
+
+    def iter_organisms(self, prefetch=True):
+        return self.iter_entity('organisms', prefetch=prefetch)
+
+    def iter_parts(self, prefetch=True):
+        return self.iter_entity('parts', prefetch=prefetch)
+
+    def iter_plans(self, prefetch=True):
+        return self.iter_entity('plans', prefetch=prefetch)
+
+    def iter_plates(self, prefetch=True):
+        return self.iter_entity('plates', prefetch=prefetch)
+
+    def iter_platesets(self, prefetch=True):
+        return self.iter_entity('platesets', prefetch=prefetch)
+
+    def iter_protocols(self, prefetch=True):
+        return self.iter_entity('protocols', prefetch=prefetch)
+
+    def iter_robots(self, prefetch=True):
+        return self.iter_entity('robots', prefetch=prefetch)
+
+    def iter_samples(self, prefetch=True):
+        return self.iter_entity('samples', prefetch=prefetch)
+
+    def iter_schemas(self, prefetch=True):
+        return self.iter_entity('schemas', prefetch=prefetch)
+
+    def iter_tags(self, prefetch=True):
+        return self.iter_entity('tags', prefetch=prefetch)
+
+
     # POST and PUT Endpoints (create and update) require same fields
 
     # Authors
@@ -963,4 +1186,39 @@ class Client(object):
 # Helper and Caching Functions
 
 Client._derive_parts = derive_parts
+Client.derive_parts_batch = derive_parts_batch
+Client._get_derived = get_derived
+Client._save_derived = save_derived
 Client._cache_parts = cache_parts
+Client._check_parts_store = check_parts_store
+Client._get_modified = get_modified
+Client._get_parts_details = get_parts_details
+Client._get_parts_records = get_parts_records
+Client._get_parts_store = get_parts_store
+Client._get_parts_index = get_parts_index
+Client.refresh_parts_cache = refresh_parts_cache
+Client._get_pages = get_pages
+Client._get_page = get_page
+Client._iter_pages = iter_pages
+Client.mirror = mirror
+Client._mirror_entity = mirror_entity
+Client._get_mirrored = get_mirrored
+
+# Bulk Functions
+
+Client._run_bulk = run_bulk
+Client._run_bulk_data = run_bulk_data
+Client.create_entities = create_entities
+Client.update_entities = update_entities
+Client.patch_entities = patch_entities
+Client._get_composite_data = get_composite_data
+
+# Composite parts derive their parts from a sequence
+for endpoint, plural, singular in ENTITIES:
+    if endpoint == "compositeparts":
+        create, update, patch = composite_bulk_functions()
+    else:
+        create, update, patch = bulk_functions(endpoint)
+    setattr(Client, "create_%s" % plural, create)
+    setattr(Client, "update_%s" % plural, update)
+    setattr(Client, "patch_%s" % plural, patch)
@@ -0,0 +1,389 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.version import __version__
+from freegenes.logger import bot
+from freegenes.main import Client
+from .entities import ENTITIES
+from .pagination import page_urls
+from .session import IDEMPOTENT_METHODS, get_delay, is_retryable
+
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncClient(object):
+    '''An asyncio client for FreeGenes, with the same get, create, update,
+       patch, and delete functions as freegenes.main.Client for each entity
+       (each is a coroutine). Throttled (429) or unavailable (5xx) responses
+       and connection errors are retried with jittered exponential backoff,
+       like the Session of the client. Requires aiohttp (pip install
+       freegenes[async]).
+
+       Usage:
+       =====
+       async with AsyncClient() as client:
+           parts = await client.get_parts()
+           results = await asyncio.gather(*[client.get_parts(uuid=x['uuid'])
+                                            for x in parts])
+
+       Parameters
+       ==========
+       token: the FreeGenes token (or FREEGENES_TOKEN in environ)
+       base: the FreeGenes base (or FREEGENES_BASE in environ)
+       validate: test the token before the first request (default True)
+       concurrency: the maximum number of requests in flight (default 50)
+       retries: the number of retries for connection errors and for
+                429, 502, 503, and 504 responses
+       backoff: the base (seconds) of the exponential backoff
+       max_backoff: the maximum time (seconds) to wait between retries
+    '''
+    def __init__(self, token=None, base="https://freegenes.dev", validate=True,
+                       concurrency=50, retries=3, backoff=0.5, max_backoff=60):
+
+        if aiohttp is None:
+            bot.exit("aiohttp is required for the AsyncClient: pip install freegenes[async]")
+
+        self.validate = validate
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.offline = False
+        self._set_base(base)
+        self._set_token(token)
+        self._set_headers()
+        self._semaphore = None
+        self._session = None
+        self._parts_client = None
+        self._validated = not validate
+
+    def __repr__(self):
+        return "[client][freegenes][async][%s]" % __version__
+
+    def __str__(self):
+        return "[client][freegenes][async][%s]" % __version__
+
+    # Settings are shared with the synchronous client
+    _set_token = Client._set_token
+    _set_base = Client._set_base
+    _set_headers = Client._set_headers
+    _prepare_url = Client._prepare_url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        '''close the session (and connections) of the client.
+        '''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        '''the session (and semaphore) must be created with a running loop,
+           so we do it on the first request.
+        '''
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def _test_token(self):
+        '''test that the token works - this function also ensures
+           that the base is correct.
+        '''
+        if not self._validated:
+            self._validated = True
+            status, _, _ = await self._request("head", self.base)
+            if status != 200:
+                bot.exit('Provided token is invalid.')
+
+    async def _request(self, method, url, headers=None, data=None):
+        '''perform a request, with at most self.concurrency in flight, and
+           return a tuple of the status, reason, and parsed json (or None).
+           A request is retried (after waiting, without holding a slot) if
+           the server is throttling or unavailable, or it can't connect.
+        '''
+        if method != "head":
+            await self._test_token()
+
+        session = self._get_session()
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                try:
+                    async with session.request(method, url,
+                                                     headers=headers or self.headers,
+                                                     data=data) as response:
+                        if attempt >= self.retries or not is_retryable(method, response.status):
+                            result = None
+                            if response.status in [200, 201] and method != "head":
+                                result = await response.json()
+                            return response.status, response.reason, result
+                        delay = get_delay(response, attempt, self.backoff, self.max_backoff)
+                        reason = "Return value %s" % response.status
+
+                # A request that didn't connect wasn't sent, others may have been
+                except aiohttp.ClientConnectionError as exc:
+                    if attempt >= self.retries or not (isinstance(exc, aiohttp.ClientConnectorError)
+                                                       or method.upper() in IDEMPOTENT_METHODS):
+                        raise
+                    delay = get_delay(None, attempt, self.backoff, self.max_backoff)
+                    reason = str(exc)
+
+            bot.debug("%s for %s, retrying in %.2f seconds." %(reason, url, delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    # Specific API calls
+
+    async def get(self, url, headers=None, paginate=True, limit=1000):
+        '''the default get, will use default headers if custom aren't defined.
+           we take a partial url (e.g., /api/authors) and then add the base.
+           If there is more than one page, the remaining pages are
+           retrieved concurrently.
+
+           Parameters
+           ==========
+           url: the url endpoint to query (without the http/s or domain)
+           headers: if defined, don't use default headers.
+           paginate: obtain all pages after query (default is True)
+           limit: number of responses per query (default 1000)
+        '''
+        fullurl = "%s?limit=%s" %(self._prepare_url(url), limit)
+        if url.startswith('http'):
+            fullurl = url
+
+        status, reason, response = await self._request("get", fullurl, headers)
+        if status != 200:
+            bot.error("Error with %s, return value %s: %s" %(url, status, reason))
+            return None
+
+        results = response
+        if "results" in response:
+            results = response['results']
+
+            if paginate and response.get('next'):
+                urls = None
+                if response.get('count') is not None:
+                    urls = page_urls(response['next'], response['count'], len(results))
+
+                # Without a count, we can only follow the next links
+                if not urls:
+                    next_url = response['next']
+                    while next_url:
+                        status, reason, page = await self._request("get", next_url, headers)
+                        if status != 200:
+                            bot.exit("Error with %s, return value %s: %s" %(next_url, status, reason))
+                        results.extend(page['results'])
+                        next_url = page.get('next')
+                    return results
+
+                pages = await asyncio.gather(*[self.get(page, headers, paginate=False)
+                                               for page in urls])
+                for page in pages:
+                    if page is None:
+                        bot.exit("Error retrieving pages for %s" % url)
+                    results.extend(page)
+        return results
+
+    async def patch(self, url, data, headers=None):
+        '''a patch request is used for a partial update.
+        '''
+        return await self._create(url, "patch", data, headers, "patch")
+
+    async def post(self, url, data=None, headers=None):
+        '''a wrapper to create, providing post as the method
+        '''
+        return await self._create(url, "post", data, headers)
+
+    async def put(self, url, data=None, headers=None):
+        '''a wrapper to create, providing put as the method
+        '''
+        return await self._create(url, "put", data, headers)
+
+    async def _create(self, url, method, data=None, headers=None, name="create"):
+        '''create is a base method that can handle a put, post or patch.
+           We take a partial url (e.g., /api/authors) and then add the base.
+
+           Parameters
+           ==========
+           url: the url endpoint to query (without the http/s or domain)
+           method: the name of the request method
+           data: data to add to the request.
+           headers: if defined, don't use default headers.
+        '''
+        fullurl = self._prepare_url(url)
+
+        # Remove empty / None fields from data (not booleans!)
+        if data:
+            data = {k:v for k,v in data.items() if v not in [None, ""]}
+
+        # POST indicates create or update, we need at least one field
+        if not data:
+            bot.exit("At least one parameter must be provided for a %s" % name)
+
+        status, reason, result = await self._request(method, fullurl, headers, form_data(data))
+        if status in [200, 201]:
+            return result
+
+        bot.error("Error with %s, return value %s: %s" %(url, status, reason))
+        return None
+
+    async def delete(self, url, headers=None):
+        '''delete an entity at the url, returning True on success.
+        '''
+        status, reason, _ = await self._request("delete", self._prepare_url(url), headers)
+        if status not in [204]:
+            bot.error("Error with %s, return value %s: %s" %(url, status, reason))
+        return status == 204
+
+    # Entity Endpoints
+
+    async def create_entity(self, name, data=None):
+        '''create an entity with a POST request.
+        '''
+        return await self.post('/api/%s/' % name, data=data)
+
+    async def update_entity(self, name, uuid, data):
+        '''update an entity with a PUT request.
+        '''
+        if not uuid:
+            bot.exit("A unique id (uuid) is required to update.")
+        return await self.put('/api/%s/%s/' % (name, uuid), data)
+
+    async def patch_entity(self, name, uuid, data):
+        '''A partial update performs a patch, allowing for update of just
+           a single (or not all required) fields.
+        '''
+        return await self.patch('/api/%s/%s' % (name, uuid), data)
+
+    async def delete_entity(self, name, uuid):
+        '''delete an entity with a DELETE request.
+        '''
+        return await self.delete('/api/%s/%s' % (name, uuid))
+
+    async def get_entity(self, name, uuid=None):
+        '''return a single entity if a uuid is provided, otherwise a list
+        '''
+        if uuid:
+            return await self.get('/api/%s/%s/' % (name, uuid))
+        return await self.get('/api/%s/' % name)
+
+    async def _run_entity_request(self, func, args, kwargs):
+        '''run a create, update, or patch function of freegenes.main.Client
+           (by name) to get the request it makes (see EntityRequest), and
+           make it with this client. Composite parts derive parts with a
+           (sync) client, so they are run in a thread.
+        '''
+        request = EntityRequest(self)
+        if "composite_part" in func:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, lambda: getattr(request, func)(*args, **kwargs))
+        else:
+            getattr(request, func)(*args, **kwargs)
+        method, params = request.request
+        return await getattr(self, method)(*params)
+
+    def _get_parts_client(self):
+        '''the client used to derive parts (with its parts cache), created
+           with the token and base of this client on first use.
+        '''
+        if self._parts_client is None:
+            self._parts_client = Client(token=self.token, base=self.base, validate=False)
+        return self._parts_client
+
+
+class EntityRequest(object):
+    '''A stand in for freegenes.main.Client in its create, update, and
+       patch functions, which records the request they would make (the
+       create_entity, update_entity, or patch_entity arguments) instead of
+       making it, so the AsyncClient has the same functions without
+       repeating their fields.
+
+       Parameters
+       ==========
+       client: the AsyncClient (used to derive parts for composite parts)
+    '''
+    def __init__(self, client):
+        self.client = client
+        self.request = None
+
+    def __getattr__(self, name):
+        if name.startswith(("create_", "update_", "patch_")):
+            return getattr(Client, name).__get__(self)
+        raise AttributeError(name)
+
+    def create_entity(self, name, data=None):
+        self.request = ("create_entity", (name, data))
+
+    def update_entity(self, name, uuid, data):
+        self.request = ("update_entity", (name, uuid, data))
+
+    def patch_entity(self, name, uuid, data):
+        self.request = ("patch_entity", (name, uuid, data))
+
+    def _derive_parts(self, sequence, circular=True):
+        return self.client._get_parts_client()._derive_parts(sequence, circular)
+
+
+def form_data(data):
+    '''requests encodes list values as repeated fields, and other values
+       as strings, so we do the same for aiohttp.
+    '''
+    fields = []
+    for key, value in data.items():
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            fields.append((key, str(item)))
+    return fields
+
+
+def _entity_functions(name, singular):
+    '''generate the get, create, update, patch, and delete coroutines for
+       an entity endpoint. Create, update, and patch take the same arguments
+       as the functions of freegenes.main.Client (see EntityRequest).
+    '''
+    async def get(self, uuid=None):
+        return await self.get_entity(name, uuid)
+
+    async def create(self, *args, **kwargs):
+        return await self._run_entity_request("create_%s" % singular, args, kwargs)
+
+    async def update(self, *args, **kwargs):
+        return await self._run_entity_request("update_%s" % singular, args, kwargs)
+
+    async def patch(self, *args, **kwargs):
+        return await self._run_entity_request("patch_%s" % singular, args, kwargs)
+
+    async def delete(self, uuid):
+        return await self.delete_entity(name, uuid)
+
+    create.__doc__ = getattr(Client, "create_%s" % singular).__doc__
+    update.__doc__ = getattr(Client, "update_%s" % singular).__doc__
+    patch.__doc__ = getattr(Client, "patch_%s" % singular).__doc__
+    return get, create, update, patch, delete
+
+
+for endpoint, plural, singular in ENTITIES:
+    get, create, update, patch, delete = _entity_functions(endpoint, singular)
+    setattr(AsyncClient, "get_%s" % plural, get)
+    setattr(AsyncClient, "create_%s" % singular, create)
+    setattr(AsyncClient, "update_%s" % singular, update)
+    setattr(AsyncClient, "patch_%s" % singular, patch)
+    setattr(AsyncClient, "delete_%s" % singular, delete)
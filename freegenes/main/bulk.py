@@ -0,0 +1,233 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.logger import bot
+from .session import RateLimiter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_bulk(self, requests, workers=None, rate=None):
+    '''run a list of requests with a pool of threads, optionally limited
+       to a rate (requests per second). Each request is a tuple of
+       (key, func, args), and instead of exiting on the first error, we
+       return a result for each request, in order:
+
+         {"key": key, "success": True, "result": <json>, "error": None}
+
+       Parameters
+       ==========
+       requests: a list of (key, func, args) to call func(*args)
+       workers: the number of threads (defaults to client workers)
+       rate: if defined, the maximum number of requests per second
+    '''
+    if self.offline:
+        return [{"key": request[0], "success": False, "result": None,
+                 "error": "The client is offline."} for request in requests]
+
+    limiter = RateLimiter(rate) if rate else None
+    workers = workers or self.workers
+    self.session.reserve(workers)
+
+    def run(request):
+        key, func, args = request
+        result = {"key": key, "success": False, "result": None, "error": None}
+        try:
+            if limiter:
+                limiter.acquire()
+            response = func(*args)
+        except Exception as exc:
+            result['error'] = str(exc)
+            return result
+
+        # The client exits on some errors (e.g., an invalid token), and
+        # logs the error first
+        except SystemExit as exc:
+            result['error'] = "The request exited (%s), see the error above." % exc.code
+            return result
+
+        # Errors are returned as the response object
+        if isinstance(response, (dict, list)):
+            result['success'] = True
+            result['result'] = response
+        else:
+            result['error'] = "return value %s: %s" %(response.status_code, response.reason)
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, requests))
+
+
+def _has_data(data):
+    '''we need at least one field that isn't empty to create or update
+    '''
+    return any(v not in [None, ""] for v in (data or {}).values())
+
+
+def create_entities(self, name, records, workers=None, rate=None):
+    '''create many entities with POST requests, with a pool of threads.
+       The key for each result is the index of the record.
+
+       Parameters
+       ==========
+       name: the name of the endpoint to post to.
+       records: a list of data (dictionaries) for each entity.
+       workers: the number of threads (defaults to client workers)
+       rate: if defined, the maximum number of requests per second
+    '''
+    requests = [(i, self.create_entity, (name, data)) for i, data in enumerate(records)]
+    return self._run_bulk_data(requests, workers, rate)
+
+
+def update_entities(self, name, updates, workers=None, rate=None):
+    '''update many entities with PUT requests, with a pool of threads.
+       The key for each result is the uuid.
+
+       Parameters
+       ==========
+       name: the name of the endpoint.
+       updates: a dictionary of data to update, by uuid.
+       workers: the number of threads (defaults to client workers)
+       rate: if defined, the maximum number of requests per second
+    '''
+    requests = [(uuid, self.update_entity, (name, uuid, data)) for uuid, data in updates.items()]
+    return self._run_bulk_data(requests, workers, rate, require_key=True)
+
+
+def patch_entities(self, name, updates, workers=None, rate=None):
+    '''partially update many entities with PATCH requests, with a pool of
+       threads. The key for each result is the uuid.
+
+       Parameters
+       ==========
+       name: the name of the endpoint.
+       updates: a dictionary of data to update, by uuid.
+       workers: the number of threads (defaults to client workers)
+       rate: if defined, the maximum number of requests per second
+    '''
+    requests = [(uuid, self.patch_entity, (name, uuid, data)) for uuid, data in updates.items()]
+    return self._run_bulk_data(requests, workers, rate, require_key=True)
+
+
+def _get_bulk_error(request, require_key=False):
+    '''return the error for a request (key, func, args) that can't be run,
+       or None if it can.
+    '''
+    if require_key and not request[0]:
+        return "A unique id (uuid) is required."
+    if not _has_data(request[2][-1]):
+        return "At least one parameter must be provided."
+
+
+def run_bulk_data(self, requests, workers=None, rate=None, require_key=False, errors=None):
+    '''run requests where the last argument is data, returning an error
+       result (instead of exiting) for any request without data, or
+       without a key (uuid) if require_key is True. Errors found by the
+       caller can be provided as a lookup of key -> error.
+    '''
+    errors = errors or {}
+    errors = [errors.get(request[0]) or _get_bulk_error(request, require_key)
+              for request in requests]
+    valid = [request for request, error in zip(requests, errors) if error is None]
+    results = iter(self._run_bulk(valid, workers, rate))
+
+    results = [next(results) if error is None else
+               {"key": request[0], "success": False, "result": None, "error": error}
+               for request, error in zip(requests, errors)]
+
+    failed = len([x for x in results if not x['success']])
+    if failed:
+        bot.warning("%s of %s requests were not successful." %(failed, len(results)))
+    return results
+
+
+def bulk_functions(name):
+    '''generate the create, update, and patch functions for many entities
+       of an endpoint (e.g., create_samples and patch_parts).
+    '''
+    def create(self, records, workers=None, rate=None):
+        return self.create_entities(name, records, workers, rate)
+
+    def update(self, updates, workers=None, rate=None):
+        return self.update_entities(name, updates, workers, rate)
+
+    def patch(self, updates, workers=None, rate=None):
+        return self.patch_entities(name, updates, workers, rate)
+
+    return create, update, patch
+
+
+def _derive_composite(self, sequences, circular=True):
+    '''return (part_ids, direction_string) for each sequence, derived in
+       one batch (the parts aren't loaded if there are no sequences).
+    '''
+    if not sequences:
+        return []
+    return [([x[0] for x in selected_parts], "".join([x[1] for x in selected_parts]))
+            for selected_parts in self.derive_parts_batch(sequences, circular)]
+
+
+def get_composite_data(self, records, circular=True):
+    '''return the data for composite parts, from records with the fields
+       of create_composite_part (name, sequence, part_ids, description,
+       direction_string, composite_id, composite_type). Parts are derived
+       (in one batch) for the sequences of records without part_ids.
+    '''
+    derive = [record for record in records
+              if not record.get('part_ids') and record.get('sequence')]
+    derived = _derive_composite(self, [record['sequence'] for record in derive], circular)
+    derived = {id(record): result for record, result in zip(derive, derived)}
+
+    data = []
+    for record in records:
+        part_ids, direction_string = derived.get(id(record),
+            (record.get('part_ids'), record.get('direction_string')))
+
+        data.append({"name": record.get('name'),
+                     "parts": part_ids,
+                     "sequence": record.get('sequence'),
+                     "description": record.get('description'),
+                     "direction_string": direction_string,
+                     "composite_id": record.get('composite_id'),
+                     "composite_type": record.get('composite_type')})
+    return data
+
+
+def composite_bulk_functions():
+    '''generate the create, update, and patch functions for many composite
+       parts, which derive parts from sequences like create_composite_part
+       and patch_composite_part (e.g., create_composite_parts).
+    '''
+    def create(self, records, workers=None, rate=None, circular=True):
+        records = self._get_composite_data(list(records), circular)
+        return self.create_entities('compositeparts', records, workers, rate)
+
+    def update(self, updates, workers=None, rate=None, circular=True):
+        data = self._get_composite_data(list(updates.values()), circular)
+        return self.update_entities('compositeparts', dict(zip(updates, data)), workers, rate)
+
+    def patch(self, updates, workers=None, rate=None, circular=True):
+
+        # Parts are derived for a new sequence, and part_ids require one
+        updates = {uuid: dict(data) for uuid, data in updates.items()}
+        errors = {uuid: "If updating part_ids, a sequence must also be provided."
+                  for uuid, data in updates.items()
+                  if "part_ids" in data and "sequence" not in data}
+
+        derive = [uuid for uuid, data in updates.items() if data.get('sequence')]
+        derived = _derive_composite(self, [updates[uuid]['sequence'] for uuid in derive], circular)
+        for uuid, (part_ids, direction_string) in zip(derive, derived):
+            updates[uuid]['part_ids'] = part_ids
+            updates[uuid]['direction_string'] = direction_string
+
+        requests = [(uuid, self.patch_entity, ('compositeparts', uuid, data))
+                    for uuid, data in updates.items()]
+        return self._run_bulk_data(requests, workers, rate, require_key=True, errors=errors)
+
+    return create, update, patch
@@ -9,18 +9,305 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 from freegenes.logger import bot
+from .records import Part, Record, to_records
+from .store import PartsStore
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 
-import requests
-import os
-import re
+# Fields that must be present for a cached part, otherwise the detail
+# record is retrieved.
+PARTS_FIELDS = ["uuid", "optimized_sequence"]
 
-def cache_parts(self):
-    '''cache the parts for the client
+# The field used as a watermark for the last modification of a part
+PARTS_WATERMARK = "time_updated"
+
+
+def cache_parts(self, fields=None):
+    '''cache the parts for the client. If the client has a cache_dir,
+       parts are loaded from the persistent store when the server reports
+       they haven't changed, otherwise they are retrieved and saved.
+
+       Parameters
+       ==========
+       fields: a list of fields required for each part (PARTS_FIELDS)
     '''
     if "parts" not in self.cache:
+        store = self._get_parts_store()
+
+        if store is not None:
+            current, meta = self._check_parts_store(store)
+            if current:
+
+                # Validators from a check without them are used next time
+                store.set_meta(meta)
+                bot.debug("Loading parts from %s" % store.path)
+                parts = store.load()
+                if self.records:
+                    parts = {uuid: Part(part) for uuid, part in parts.items()}
+                self.cache['parts'] = parts
+                return
+
         bot.info("Caching parts for future requests...")
-        parts_listing = self.get_parts()
-        parts = {}
-        for part in parts_listing:
-            parts[part['uuid']] = self.get_parts(uuid=part['uuid'])
+        parts = self._get_parts_records(fields)
+
+        if store is not None:
+            meta['watermark'] = parts_watermark(parts)
+            store.save(parts, meta)
+
         self.cache['parts'] = parts
+
+
+def refresh_parts_cache(self, page_size=100):
+    '''refresh the cached parts, retrieving only the parts modified since
+       the newest one in the cache (listed newest first). If the count of
+       parts on the server doesn't match (parts were deleted) or the parts
+       don't have modification times, all parts are listed and compared.
+       The persistent store and the parts index are updated in place,
+       unless enough parts changed that the index should be rebuilt.
+
+       Parameters
+       ==========
+       page_size: the number of parts to retrieve per page
+    '''
+    if "parts" not in self.cache:
+        return self._cache_parts()
+
+    if self.offline:
+        bot.warning("The client is offline, the parts cache is not refreshed.")
+        return self.cache['parts']
+
+    parts = self.cache['parts']
+    watermark = get_newest([part.get(PARTS_WATERMARK) for part in parts.values()])
+
+    changed = {}
+    removed = []
+    count = None
+
+    if watermark is not None:
+        modified, count = self._get_modified('parts', watermark, page_size)
+        changed = {part['uuid']: part for part in modified
+                   if is_changed(parts.get(part['uuid']), part)}
+
+    new = [uuid for uuid in changed if uuid not in parts]
+    if count is None or count != len(parts) + len(new):
+        bot.debug("Listing all parts to refresh the parts cache.")
+        records = self.get('/api/parts/', cache=False)
+        latest = {part['uuid']: part for part in records}
+        changed = {uuid: part for uuid, part in latest.items()
+                   if is_changed(parts.get(uuid), part)}
+        removed = [uuid for uuid in parts if uuid not in latest]
+
+    if not changed and not removed:
+        bot.debug("Parts cache is current.")
+        return parts
+
+    bot.info("Refreshing %s changed and %s removed parts." % (len(changed), len(removed)))
+    changed = self._get_parts_details(changed)
+    parts.update(changed)
+    for uuid in removed:
+        del parts[uuid]
+
+    store = self._get_parts_store()
+    if store is not None:
+        store.update(changed, removed, {"watermark": parts_watermark(parts)})
+
+    index = self._parts_index
+    if index is not None and index.parts is parts:
+        if index.is_fragmented():
+            self._parts_index = None
+        else:
+            index.update(changed, removed)
+    return parts
+
+
+def get_modified(self, name, watermark, page_size=100):
+    '''list the records of an entity modified since a watermark (the
+       newest time_updated known), newest first, and stop at the first
+       record older than the watermark. Records modified at the watermark
+       are included, since others could have been modified in the same
+       instant after the last sync. We return (records, count), with the
+       count of all records on the server (None if not provided). Times
+       are compared as dates (their offsets can differ), and if a page is
+       not newest first (the server doesn't order by time), we return no
+       records and a count of None, so the caller lists all records.
+
+       Parameters
+       ==========
+       name: the name of the entity endpoint (e.g., parts)
+       watermark: the newest modification time known
+       page_size: the number of records to retrieve per page
+    '''
+    url = "%s?limit=%s&ordering=-%s" % (self._prepare_url('/api/%s/' % name),
+                                        page_size, PARTS_WATERMARK)
+    watermark = parse_time(watermark)
+    if watermark is None:
+        return [], None
+
+    records = []
+    count = None
+
+    while url:
+        page = self._get_page(url, self.headers)
+        count = page.get('count', count)
+        url = page.get('next')
+
+        results = page.get('results', [])
+        times = [parse_time(record.get(PARTS_WATERMARK)) for record in results]
+        if records:
+            times.insert(0, parse_time(records[-1].get(PARTS_WATERMARK)))
+        if None in times or times != sorted(times, reverse=True):
+            bot.debug("%s are not listed newest first, listing all." % name)
+            return [], None
+
+        for record in results:
+            if parse_time(record.get(PARTS_WATERMARK)) < watermark:
+                url = None
+                break
+            records.append(record)
+
+    if self.records:
+        records = self.loader.bind(to_records(records, name))
+    return records, count
+
+
+def get_parts_records(self, fields=None):
+    '''retrieve all parts, returning a lookup by uuid. The listing already
+       returns part records, so we only retrieve a detail record for the
+       parts that are missing one or more required fields, using a pool of
+       self.workers threads. The response cache is not used, since the
+       parts cache is checked against the server separately.
+
+       Parameters
+       ==========
+       fields: a list of fields required for each part (PARTS_FIELDS)
+    '''
+    parts = {part['uuid']: part for part in self.get('/api/parts/', cache=False)}
+    return self._get_parts_details(parts, fields)
+
+
+def get_parts_details(self, parts, fields=None):
+    '''retrieve the detail record for the parts (a lookup by uuid) that
+       are missing one or more required fields, using a pool of
+       self.workers threads. The lookup is updated and returned.
+
+       Parameters
+       ==========
+       parts: a lookup of parts by uuid
+       fields: a list of fields required for each part (PARTS_FIELDS)
+    '''
+    fields = fields or PARTS_FIELDS
+    missing = [uuid for uuid, part in parts.items()
+               if any(field not in part for field in fields)]
+
+    if missing:
+        bot.debug("Retrieving %s part details." % len(missing))
+        get_part = lambda uuid: self.get('/api/parts/%s/' % uuid, cache=False)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for uuid, part in zip(missing, executor.map(get_part, missing)):
+                if isinstance(part, (dict, Record)):
+                    parts[uuid] = part
+                else:
+                    bot.warning("Could not retrieve details for part %s" % uuid)
+    return parts
+
+
+def get_parts_store(self):
+    '''return the persistent parts store, or None if the client doesn't
+       have a cache directory.
+    '''
+    if self.cache_dir and self._parts_store is None:
+        self._parts_store = PartsStore(self.cache_dir, self.base)
+    return self._parts_store
+
+
+def check_parts_store(self, store):
+    '''check if the parts in the store are current with the server, with
+       one conditional request for the first page of parts (newest first).
+       The store is current if the server responds with 304 (not modified)
+       or if the count and newest modification time are unchanged. We
+       return a tuple (current, meta) with the validators to save.
+    '''
+    meta = {}
+    if not len(store):
+        return False, meta
+
+    # An offline client uses the store as it is
+    if self.offline:
+        return True, meta
+
+    headers = dict(self.headers)
+    etag = store.get_meta('etag')
+    modified = store.get_meta('last_modified')
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    url = "%s?limit=1&ordering=-%s" % (self._prepare_url('/api/parts/'), PARTS_WATERMARK)
+    self._check_request(url)
+    response = self.session.get(url, headers=headers)
+
+    if response.status_code == 304:
+        return True, meta
+
+    if response.status_code != 200:
+        bot.warning("Cannot check parts cache, return value %s: %s" % (response.status_code,
+                                                                       response.reason))
+        return False, meta
+
+    meta = {"etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified')}
+
+    # Without server validators, compare the count and newest change
+    result = response.json()
+    newest = (result.get('results') or [{}])[0].get(PARTS_WATERMARK)
+    if newest is None:
+        return False, meta
+
+    watermark = "%s|%s" % (result.get('count'), newest)
+    return watermark == store.get_meta('watermark'), meta
+
+
+def is_changed(cached, part):
+    '''determine if a part (from a listing) changed from the cached part,
+       which can have more fields (if it's a detail record).
+    '''
+    if cached is None:
+        return True
+    return any(cached.get(key) != value for key, value in part.items())
+
+
+def parts_watermark(parts):
+    '''a watermark for a set of parts, the count and the newest modification
+       time, or None if the parts don't have modification times.
+    '''
+    newest = get_newest([part.get(PARTS_WATERMARK) for part in parts.values()])
+    if newest is not None:
+        return "%s|%s" % (len(parts), newest)
+
+
+def parse_time(value):
+    '''parse a modification time (ISO 8601, e.g., 2019-06-27T21:45:51-05:00)
+       to a datetime with a timezone (UTC if it doesn't have an offset), so
+       times with different offsets can be compared. We return None if
+       it's not defined or can't be parsed.
+    '''
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+def get_newest(times):
+    '''return the newest of a list of modification times (as it is, a
+       string), or None if there are none or one can't be parsed.
+    '''
+    parsed = [parse_time(value) for value in times]
+    if not parsed or None in parsed:
+        return None
+    return times[parsed.index(max(parsed))]
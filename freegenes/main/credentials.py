@@ -0,0 +1,131 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.utils import mkdir_p
+from freegenes.logger import bot
+
+import base64
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+
+
+def get_credentials_key(*values):
+    '''return a key for credentials from the values that identify them
+       (e.g., the base and the tokens), hashed so tokens aren't stored
+       as keys.
+    '''
+    return hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def get_token_expiry(token):
+    '''return the expiration (seconds since the epoch) of a JWT, or None
+       if the token doesn't have one (or isn't a JWT).
+    '''
+    try:
+        payload = token.split('.')[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload).decode('utf-8'))['exp'])
+    except Exception:
+        return None
+
+
+class CredentialCache(object):
+    '''A local file of credentials (e.g., a token obtained with a login,
+       or the result of validating a token) so that a new client doesn't
+       need to authenticate and validate again. Each entry expires after
+       ttl seconds, or when its token expires (if sooner). The file is only
+       readable by the user (mode 600), and is ignored if it's readable by
+       anyone else.
+
+       Parameters
+       ==========
+       path: the path to the credentials file (created if it doesn't exist)
+       ttl: the time (seconds) to keep an entry
+    '''
+    def __init__(self, path, ttl=3600):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "[credentials][%s]" % self.path
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get(self, key):
+        '''return the entry (a dictionary) for a key, or None if there
+           isn't one (or it expired).
+        '''
+        entry = self._load().get(key)
+        if entry and entry.get('expires', 0) > time.time():
+            return entry
+
+    def set(self, key, expires=None, **fields):
+        '''set fields of the entry for a key, which expires after the ttl
+           (or at expires, if sooner).
+        '''
+        expires = min(time.time() + self.ttl, expires or float('inf'))
+        with self.lock:
+            entries = self._load()
+            entry = entries.get(key, {})
+            entry.update(fields)
+            entry['expires'] = expires
+            entries[key] = entry
+            self._save(entries)
+
+    def clear(self, key=None):
+        '''remove the entry for a key (or all entries if None).
+        '''
+        with self.lock:
+            entries = self._load()
+            if key is None:
+                entries = {}
+            entries.pop(key, None)
+            self._save(entries)
+
+    def _load(self):
+        '''load the entries from the file, without expired entries.
+        '''
+        try:
+            mode = os.stat(self.path).st_mode
+            if mode & (stat.S_IRWXG | stat.S_IRWXO):
+                bot.warning("%s is readable by others, not using it." % self.path)
+                return {}
+            with open(self.path) as filey:
+                entries = json.load(filey)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        now = time.time()
+        return {key: entry for key, entry in entries.items()
+                if entry.get('expires', 0) > now}
+
+    def _save(self, entries):
+        '''write the entries to the file (replaced so a reader never sees
+           a partial file), only readable by the user.
+        '''
+        dirname = os.path.dirname(self.path)
+        mkdir_p(dirname)
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as filey:
+                os.chmod(tmp, stat.S_IRUSR | stat.S_IWUSR)
+                json.dump(entries, filey)
+            os.replace(tmp, self.path)
+        except (IOError, OSError):
+            bot.warning("Cannot write credentials to %s" % self.path)
+            if os.path.exists(tmp):
+                os.remove(tmp)
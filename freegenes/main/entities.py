@@ -0,0 +1,35 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+# Entities served by the FreeGenes API, as (endpoint, plural, singular),
+# where the plural and singular names are used for client functions
+# (e.g., get_composite_parts and patch_composite_part)
+
+ENTITIES = [
+    ("authors", "authors", "author"),
+    ("collections", "collections", "collection"),
+    ("compositeparts", "composite_parts", "composite_part"),
+    ("containers", "containers", "container"),
+    ("distributions", "distributions", "distribution"),
+    ("institutions", "institutions", "institution"),
+    ("modules", "modules", "module"),
+    ("operations", "operations", "operation"),
+    ("orders", "orders", "order"),
+    ("organisms", "organisms", "organism"),
+    ("parts", "parts", "part"),
+    ("plans", "plans", "plan"),
+    ("plates", "plates", "plate"),
+    ("platesets", "platesets", "plateset"),
+    ("protocols", "protocols", "protocol"),
+    ("robots", "robots", "robot"),
+    ("samples", "samples", "sample"),
+    ("schemas", "schemas", "schema"),
+    ("tags", "tags", "tag"),
+]
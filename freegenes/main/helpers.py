@@ -9,85 +9,289 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 from freegenes.logger import bot
+from bisect import bisect_right
 
-import requests
-import os
-import re
+import hashlib
+import heapq
+import json
+import multiprocessing
 
-def derive_parts(self, sequence, circular=True):
+
+def derive_parts(self, sequence, circular=True, identity=None, max_mismatches=None, top=1):
     '''based on a sequence, search all freegenes parts for the sequence,
        forward and backwards. This is done by the client (and not on the
        server) as to not tax the server. We cache the parts request to
        not make the same one over and over. If the sequence is circular,
-       we add it to itself, otherwise not.
+       parts can wrap around the origin (their end is past the length).
 
        Algorithm:
        =========
        1. Cache all parts from the API (one call)
-       2. Find all forward and reverse substrings that match
-       3. Model as interview scheduling problem
+       2. Find all forward and reverse substrings that match, using an
+          automaton over all parts that is built once per parts cache
+       3. Model as weighted interval scheduling problem, to select the set
+          of non overlapping parts that covers the most of the sequence
+
+       If the user is interested in other combinations of parts, top > 1
+       will return a list of the top best selections (best first).
+
+       Results are memoized by a hash of the sequence and options, with the
+       parts index (and in the persistent store if there is a cache_dir),
+       so they are dropped when the parts cache is refreshed.
+
+       Parameters
+       ==========
+       sequence: the sequence to search for parts
+       circular: is the sequence circular? (default True)
+       identity: if defined, also find parts that match with substitutions,
+                 with at least this fraction of the part matching (e.g., 0.95)
+       max_mismatches: if defined with identity, the maximum substitutions
+       top: if more than 1, return a list of the top best selections
+    '''
+    # The search structures are only loaded (or built) if there's no result
+    index = self._get_parts_index()
+    key = get_derived_key(sequence, circular, identity, max_mismatches, top)
+
+    result = self._get_derived(index, [key]).get(key)
+    if result is None:
+        index = self._get_parts_index(kmers=identity is not None)
+        result = search_index(index, sequence, circular, identity, max_mismatches, top)
+        self._save_derived(index, {key: result})
+    return copy_derived(result, top)
+
+
+def get_derived_key(sequence, circular=True, identity=None, max_mismatches=None, top=1):
+    '''a key to memoize the parts derived for a sequence with options. The
+       parts themselves are not part of the key, since derived results are
+       kept with the parts index (or saved with its fingerprint).
+    '''
+    options = json.dumps([circular, identity, max_mismatches, top])
+    return hashlib.sha256(("%s\n%s" %(options, sequence)).encode('utf-8')).hexdigest()
+
+
+def get_derived(self, index, keys):
+    '''return a lookup of key -> result for derived parts that are memoized
+       with the index, or saved in the persistent store for the same parts.
+    '''
+    results = {}
+    missing = []
+    for key in keys:
+        result = index.get_memo(key)
+        if result is None:
+            missing.append(key)
+        else:
+            results[key] = result
+
+    store = self._get_parts_store()
+    if missing and store is not None:
+        for key, result in store.get_results(index.fingerprint, missing).items():
+            result = _load_derived(result)
+            index.set_memo(key, result)
+            results[key] = result
+    return results
+
+
+def save_derived(self, index, results):
+    '''memoize derived parts (a lookup of key -> result) with the index,
+       and save them to the persistent store if there is one.
+    '''
+    for key, result in results.items():
+        index.set_memo(key, result)
+
+    store = self._get_parts_store()
+    if results and store is not None:
+        store.save_results(index.fingerprint, results)
+
+
+def copy_derived(result, top=1):
+    '''copy a memoized result, so the caller can't change the memo.
+    '''
+    if top == 1:
+        return list(result)
+    return [list(tiling) for tiling in result]
+
+
+def _load_derived(result):
+    '''convert a result loaded from json (lists) back to tuples of parts.
+    '''
+    if result and (not result[0] or isinstance(result[0][0], list)):
+        return [[tuple(part) for part in tiling] for tiling in result]
+    return [tuple(part) for part in result]
+
 
-       If the user is interested in ALL possible combinations of parts,
-       we would want to remove the "best solution" parts (the first part)
-       from the list and try again.
+def search_index(index, sequence, circular=True, identity=None, max_mismatches=None, top=1):
+    '''search a parts index for a sequence and select the parts, the
+       steps of derive_parts after the index is loaded.
     '''
-    self._cache_parts()
+    # Parts found to match, circular sequences are searched with a window
+    coords = index.search(sequence, circular=circular)
 
-    # To account for circular sequences
-    if circular:
-        sequence = sequence + sequence
+    # Approximate matches include the exact ones
+    if identity is not None:
+        coords = list(set(coords + index.search_approximate(sequence, identity, max_mismatches,
+                                                            circular=circular)))
 
-    # Parts found to match
-    coords = []
+    tilings = select_parts(coords, top=top, length=len(sequence) if circular else None)
+    if top == 1:
+        return tilings[0]
+    return tilings
 
-    for uuid, part in self.cache['parts'].items():
 
-        # Only use parts with optimized sequences
-        if part.get('optimized_sequence'):
-            forward = part['optimized_sequence']
-            reverse = forward[::-1]
+# The index shared with worker processes of derive_parts_batch. With fork,
+# workers inherit it from the parent (pages are copied only on write),
+# otherwise it's sent once to each worker by the pool initializer.
+_batch_index = None
 
-            # Case 1: we found the forward sequence
-            if forward in sequence:
-                for match in re.finditer(forward, sequence): 
-                    coords.append((part.get('uuid'), ">", match.start(), match.end()))
 
-            # Case 2: we found the reverse sequence
-            if reverse in sequence:
-                for match in re.finditer(reverse, sequence): 
-                    coords.append((part.get('uuid'), "<", match.start(), match.end()))
+def _set_batch_index(index):
+    global _batch_index
+    _batch_index = index
 
-    # Make a queue sorted by how long they (end - start)
-    queue = sorted(coords, key=lambda tup: tup[3]-tup[2])
 
-    def overlaps_with(selected_sequences, element):
-        '''determine if an element overlaps with any current elements in the
-           list
-        '''
-        for selected in selected_sequences:
+def _search_batch_index(args):
+    return search_index(_batch_index, *args)
 
-           # If the element start is greater than selected start, less than end
-           if (element[2] >= selected[2]) and (element[2] < selected[3]):
-               return True
 
-           # If the element end is greater than the selected start, less than end
-           if (element[3] > selected[2]) and (element[3] <= selected[3]):
-               return True
+def derive_parts_batch(self, sequences, circular=True, workers=None, identity=None,
+                       max_mismatches=None, chunksize=None):
+    '''derive parts (see derive_parts) for many sequences, using a pool of
+       processes (one per core by default) that share the parts index. The
+       index is built once, before the pool is started, and only if some
+       sequences don't have memoized (or saved) results.
 
-        return False
- 
-    selected_sequences = []
+       Parameters
+       ==========
+       sequences: a list of sequences to search for parts
+       circular: are the sequences circular? (default True)
+       workers: the number of processes (default is the number of cores)
+       identity: if defined, also find parts that match with substitutions
+       max_mismatches: if defined with identity, the maximum substitutions
+       chunksize: the number of sequences sent to a process at once
+
+       Returns
+       =======
+       a list of (uuid, direction, start, end) lists, one per sequence
+    '''
+    index = self._get_parts_index()
+    sequences = list(sequences)
+    keys = [get_derived_key(sequence, circular, identity, max_mismatches)
+            for sequence in sequences]
+
+    # Only search (once) for sequences that aren't memoized
+    results = self._get_derived(index, keys)
+    missing = {}
+    for key, sequence in zip(keys, sequences):
+        if key not in results:
+            missing[key] = sequence
+
+    tasks = [(sequence, circular, identity, max_mismatches) for sequence in missing.values()]
+    if tasks:
+        index = self._get_parts_index(kmers=identity is not None)
+    found = _search_batch(index, tasks, workers, chunksize)
+    found = dict(zip(missing, found))
+    self._save_derived(index, found)
+    results.update(found)
+
+    return [copy_derived(results[key]) for key in keys]
+
+
+def _search_batch(index, tasks, workers=None, chunksize=None):
+    '''search the index for a list of tasks (arguments for search_index)
+       with a pool of processes, returning the results in order.
+    '''
+    global _batch_index
+
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    if workers <= 1:
+        return [search_index(index, *task) for task in tasks]
+
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (workers * 4))
+
+    # Build the automaton once, so workers don't each build it
+    index.get_automaton()
+
+    bot.debug("Deriving parts for %s sequences with %s processes." %(len(tasks), workers))
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        _batch_index = index
+        try:
+            with context.Pool(workers) as pool:
+                return pool.map(_search_batch_index, tasks, chunksize)
+        finally:
+            _batch_index = None
+
+    with multiprocessing.Pool(workers, _set_batch_index, (index,)) as pool:
+        return pool.map(_search_batch_index, tasks, chunksize)
+
+
+def select_parts(coords, top=1, weight=None, length=None):
+    '''select the best set of non overlapping parts (a tiling), by default
+       the set that covers the most of the sequence. This is weighted
+       interval scheduling, solved with dynamic programming over the parts
+       sorted by end, where a binary search finds the last part that ends
+       before each part starts, so it's O(n log n) for n parts found. For
+       top > 1, we keep the top best solutions for each prefix of parts,
+       and return the top best tilings (best first).
+
+       If the length of a circular sequence is provided, parts can wrap
+       around the origin (end > length), and at most one of them can be
+       selected. We compare the best tiling without a wrapping part to the
+       best tiling with each, from the parts between its end and start.
+
+       Parameters
+       ==========
+       coords: a list of (uuid, direction, start, end) for parts found
+       top: the number of tilings to return (default 1)
+       weight: a function to weight a part, default is the length
+       length: the length of the sequence, if it's circular
+    '''
+    weight = weight or (lambda part: part[3] - part[2])
+    if length is None:
+        return [tiling for score, tiling in _select_parts(coords, top, weight)]
+
+    linear = [part for part in coords if part[3] <= length]
+    tilings = _select_parts(linear, top, weight)
+
+    for part in coords:
+        if part[3] > length:
+            inside = [x for x in linear if x[2] >= part[3] - length and x[3] <= part[2]]
+            score = weight(part)
+            tilings += [(total + score, tiling + [part])
+                        for total, tiling in _select_parts(inside, top, weight)]
+
+    tilings = heapq.nlargest(top, tilings, key=lambda x: x[0])
+    return [tiling for score, tiling in tilings]
+
+
+def _select_parts(coords, top, weight):
+    '''the dynamic programming for select_parts, returning a list of the
+       top (score, tiling) for a linear sequence.
+    '''
+    parts = sorted(coords, key=lambda part: (part[3], part[2]))
+    ends = [part[3] for part in parts]
 
-    while queue:
+    # best[i] are the top (score, chain) using the first i parts, where
+    # a chain is a linked list of (part, chain) to reconstruct a tiling
+    best = [[(0, None)]]
 
-        # Pop the longest element ( the last )
-        element = queue.pop()
+    for i, part in enumerate(parts):
 
-        # If there is no overlap add
-        if not overlaps_with(selected_sequences, element):
-            selected_sequences.append(element)
+        # The parts (up to previous) that end before this part starts
+        previous = bisect_right(ends, part[2], 0, i)
+        score = weight(part)
+        included = [(total + score, (part, chain)) for total, chain in best[previous]]
 
-    # Need to sort them again, by the start
-    selected_sequences = sorted(selected_sequences, key=lambda tup: tup[2])
+        if top == 1:
+            best.append([max(best[i][0], included[0], key=lambda x: x[0])])
+        else:
+            best.append(heapq.nlargest(top, best[i] + included, key=lambda x: x[0]))
 
-    return selected_sequences
+    tilings = []
+    for total, chain in best[-1]:
+        tiling = []
+        while chain is not None:
+            part, chain = chain
+            tiling.append(part)
+        tilings.append((total, tiling[::-1]))
+    return tilings
@@ -0,0 +1,273 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.utils.automaton import Automaton
+from freegenes.utils.nucleotide import (
+    PackedSequence,
+    encode,
+    is_nucleotide,
+    reverse_complement
+)
+from freegenes.logger import bot
+from .kmers import KmerIndex
+
+from collections import OrderedDict
+import hashlib
+import itertools
+
+
+class PartsIndex(object):
+    '''A search index over the optimized sequences of all cached parts,
+       forward and reverse complement, so that a query sequence can be
+       searched for every part with one linear pass. The automaton runs
+       over nucleotide codes, and the index keeps a copy of each part in
+       both directions packed 2 bits per base (about half a byte per base,
+       in addition to the parts cache) to verify approximate matches
+       without unpacking. Parts with ambiguous letters (e.g., N) can't be
+       packed, and are searched as strings. An index of k-mers to find
+       approximate matches is loaded or built on demand, and the automaton
+       is built on the first search.
+
+       A circular sequence is searched once, plus a window of the start of
+       the sequence (the longest part minus one) to find parts that wrap
+       around. A part that wraps has a start in the sequence and an end
+       past its length (end - length is the position after the origin).
+
+       Results derived from the index are memoized (least recently used,
+       up to memo_size), so they are dropped with the index when the parts
+       change. Parts that change can be updated without a rebuild.
+    '''
+    def __init__(self, parts, memo_size=1024):
+        self.parts = parts
+        self.size = len(parts)
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+
+        # Lists of (uuid, direction, sequence), ordered to be reproducible.
+        # Packed patterns are identified by their position in the list.
+        self.patterns = []
+        self.ambiguous = []
+        self.ids = {}
+        for uuid in sorted(parts):
+            self._add_part(uuid, parts[uuid])
+
+        # Patterns added (and removed) by update are searched separately
+        self.base = len(self.patterns)
+        self.removed = set()
+        self.delta = None
+        self.kmers = None
+        self.delta_kmers = None
+
+        self.automaton = None
+
+        digest = hashlib.sha1()
+        for uuid, direction, sequence in self.patterns:
+            digest.update(("%s%s%s\n" %(uuid, direction, len(sequence))).encode('utf-8'))
+            digest.update(sequence.data)
+        for uuid, direction, sequence in self.ambiguous:
+            digest.update(("%s%s%s\n" %(uuid, direction, sequence)).encode('utf-8'))
+        self.fingerprint = self.base_fingerprint = digest.hexdigest()
+        self._set_max_length()
+
+    def _add_part(self, uuid, part):
+        '''add the patterns (forward and reverse complement) for a part.
+        '''
+        # Only use parts with optimized sequences
+        forward = part.get('optimized_sequence')
+        if forward:
+            uuid = part.get('uuid', uuid)
+            if is_nucleotide(forward):
+                forward = PackedSequence(forward)
+                self.ids[uuid] = [len(self.patterns), len(self.patterns) + 1]
+                self.patterns.append((uuid, ">", forward))
+                self.patterns.append((uuid, "<", forward.reverse_complement()))
+            else:
+                forward = forward.upper()
+                self.ambiguous.append((uuid, ">", forward))
+                self.ambiguous.append((uuid, "<", reverse_complement(forward)))
+
+    def _set_max_length(self):
+        self.max_length = max([len(pattern[2]) for pattern in self.patterns + self.ambiguous] or [0])
+
+    def is_current(self, parts):
+        '''determine if the index was built from the parts provided.
+        '''
+        return parts is self.parts and len(parts) == self.size
+
+    def update(self, parts, removed=None):
+        '''update the index for parts that were added or changed (a lookup
+           by uuid) and the uuids of parts that were removed, without
+           rebuilding it. The patterns of changed or removed parts are marked
+           as removed, and new patterns are added to a small automaton (the
+           delta) that is searched along with the main one.
+        '''
+        stale = set(parts) | set(removed or [])
+        for uuid in stale:
+            self.removed.update(self.ids.pop(uuid, []))
+        self.ambiguous = [pattern for pattern in self.ambiguous if pattern[0] not in stale]
+
+        digest = hashlib.sha1(self.fingerprint.encode('utf-8'))
+        for uuid in sorted(stale):
+            digest.update(("%s\n" % uuid).encode('utf-8'))
+            if uuid in parts:
+                self._add_part(uuid, parts[uuid])
+                digest.update(str(parts[uuid].get('optimized_sequence')).encode('utf-8'))
+
+        self.delta = Automaton(alphabet=range(4))
+        self.delta.build((self.patterns[i][2].codes(), i)
+                         for i in range(self.base, len(self.patterns)) if i not in self.removed)
+        self.delta_kmers = None
+
+        self.size = len(self.parts)
+        self.fingerprint = digest.hexdigest()
+        self.memo.clear()
+        self._set_max_length()
+
+    def is_fragmented(self, fraction=0.1, minimum=1000):
+        '''determine if enough patterns were updated that the index should
+           be rebuilt (more than a fraction of the patterns, or minimum).
+        '''
+        updated = len(self.patterns) - self.base + len(self.removed)
+        return updated > max(minimum, fraction * self.base)
+
+    def get_memo(self, key):
+        '''return a memoized result, or None if it's not in the memo.
+        '''
+        result = self.memo.get(key)
+        if result is not None:
+            self.memo.move_to_end(key)
+        return result
+
+    def set_memo(self, key, result):
+        '''memoize a result, removing the least recently used if full.
+        '''
+        self.memo[key] = result
+        self.memo.move_to_end(key)
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+
+    def get_wrap_window(self, sequence, circular):
+        '''return the start of a circular sequence that must be searched
+           after its end to find parts that wrap around the origin.
+        '''
+        if not circular:
+            return sequence[:0]
+        return sequence[:min(self.max_length, len(sequence)) - 1]
+
+    def search(self, sequence, circular=False):
+        '''return a list of (uuid, direction, start, end) for every part
+           found in the sequence, forward or reverse complement. For a
+           circular sequence, parts that wrap have an end past the length.
+        '''
+        length = len(sequence)
+        codes = encode(sequence)
+        codes += self.get_wrap_window(codes, circular)
+
+        matches = self.get_automaton().search(codes)
+        if self.delta is not None:
+            matches = itertools.chain(matches, self.delta.search(codes))
+
+        # Matches that start in the window were found at the start
+        coords = [self.patterns[i][:2] + (start, end)
+                  for start, end, i in matches
+                  if start < length and i not in self.removed]
+
+        if self.ambiguous:
+            sequence = sequence.upper()
+            sequence += self.get_wrap_window(sequence, circular)
+            for uuid, direction, pattern in self.ambiguous:
+                start = sequence.find(pattern)
+                while start != -1 and start < length:
+                    coords.append((uuid, direction, start, start + len(pattern)))
+                    start = sequence.find(pattern, start + 1)
+        return coords
+
+    def get_automaton(self):
+        '''return the automaton (of the patterns the index was built with),
+           building it on the first search, so that an index used only for
+           memoized results (or its fingerprint) is cheap to create.
+        '''
+        if self.automaton is None:
+            bot.debug("Building search automaton for %s parts." % (self.base // 2))
+            self.automaton = Automaton(alphabet=range(4))
+            self.automaton.build((self.patterns[i][2].codes(), i) for i in range(self.base))
+        return self.automaton
+
+    def get_kmers(self):
+        '''return the k-mer index (of the patterns the index was built
+           with), building it if it wasn't set.
+        '''
+        if self.kmers is None:
+            self.kmers = KmerIndex(pattern[2].codes() for pattern in self.patterns[:self.base])
+        return self.kmers
+
+    def get_delta_kmers(self):
+        '''return the k-mer index of the patterns added by update.
+        '''
+        if self.delta_kmers is None:
+            self.delta_kmers = KmerIndex(pattern[2].codes() for pattern in self.patterns[self.base:])
+        return self.delta_kmers
+
+    def search_approximate(self, sequence, identity=0.95, max_mismatches=None,
+                                 circular=False):
+        '''return a list of (uuid, direction, start, end) for every part
+           found in the sequence, forward or reverse complement, allowing for
+           substitutions (at least identity of the part must match).
+        '''
+        length = len(sequence)
+        codes = encode(sequence)
+        codes += self.get_wrap_window(codes, circular)
+
+        matches = self.get_kmers().search(codes,
+                                          lambda i: self.patterns[i][2],
+                                          identity, max_mismatches)
+        if len(self.patterns) > self.base:
+            delta = self.get_delta_kmers().search(codes,
+                                                  lambda i: self.patterns[self.base + i][2],
+                                                  identity, max_mismatches)
+            matches += [(self.base + i, start, end) for i, start, end in delta]
+
+        return [self.patterns[i][:2] + (start, end)
+                for i, start, end in matches
+                if start < length and i not in self.removed]
+
+
+def get_parts_index(self, kmers=False):
+    '''return the index for the cached parts, building it only if the
+       parts in the cache have changed since it was last built.
+
+       Parameters
+       ==========
+       kmers: also load (or build and save) the k-mer index
+    '''
+    self._cache_parts()
+    parts = self.cache['parts']
+
+    if self._parts_index is None or not self._parts_index.is_current(parts):
+        bot.debug("Building search index for %s parts." % len(parts))
+        self._parts_index = PartsIndex(parts)
+
+    index = self._parts_index
+    if kmers and index.kmers is None:
+        store = self._get_parts_store()
+        if store is not None:
+            data = store.get_blob('kmers', index.base_fingerprint)
+            if data is not None:
+                try:
+                    index.kmers = KmerIndex.loads(data)
+                except ValueError as exc:
+                    bot.warning("Cannot load the saved k-mer index, rebuilding: %s" % exc)
+
+        if index.kmers is None:
+            bot.debug("Building k-mer index for %s parts." % len(parts))
+            index.get_kmers()
+            if store is not None:
+                store.save_blob('kmers', index.base_fingerprint, index.kmers.dumps())
+    return index
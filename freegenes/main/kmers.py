@@ -0,0 +1,204 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.utils.nucleotide import PackedQuery, encode
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+import json
+import sys
+import zlib
+
+
+def minimizers(sequence, k=15, w=10):
+    '''yield (position, hash) for the minimizers of a sequence, the k-mer
+       with the smallest hash in each window of w consecutive k-mers. We
+       use a stable hash (not python's hash) so an index can be saved.
+       The sequence is a string or nucleotide codes (see encode), and
+       letters that aren't nucleotides (e.g., N) break a k-mer.
+    '''
+    if isinstance(sequence, str):
+        sequence = encode(sequence)
+
+    mask = (1 << (2 * k)) - 1
+    code = 0
+    valid = 0
+    window = deque()
+    last = None
+
+    for end, value in enumerate(sequence, 1):
+        if value > 3:
+            valid = 0
+            window.clear()
+            continue
+
+        code = ((code << 2) | value) & mask
+        valid += 1
+        if valid < k:
+            continue
+
+        position = end - k
+        hashed = (code * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+
+        # Monotone queue, the front is the minimizer of the window
+        while window and window[-1][1] >= hashed:
+            window.pop()
+        window.append((position, hashed))
+        while window[0][0] <= position - w:
+            window.popleft()
+
+        if valid >= k + w - 1 and window[0] != last:
+            last = window[0]
+            yield last
+
+    # A sequence shorter than a window still has a minimizer
+    if window and last is None:
+        yield window[0]
+
+
+class KmerIndex(object):
+    '''A minimizer index over sequences (e.g., parts in each direction),
+       to find approximate matches of the sequences in a query. Each query
+       minimizer that is also in a sequence suggests an alignment (the
+       diagonal), and alignments are verified by counting mismatches, so
+       we find sequences with substitutions (not insertions or deletions).
+
+       The index is stored as sorted arrays, so it's compact to keep in
+       memory and to save (dumps and loads).
+
+       Parameters
+       ==========
+       sequences: a list of sequences (strings or nucleotide codes) to index,
+                  the id of each is the index in the list
+       k: the length of a k-mer
+       w: the number of k-mers in a window
+    '''
+    def __init__(self, sequences=None, k=15, w=10):
+        self.k = k
+        self.w = w
+        self.keys = array('Q')
+        self.starts = array('L', [0])
+        self.ids = array('L')
+        self.positions = array('L')
+
+        if sequences:
+            self.build(sequences)
+
+    def build(self, sequences):
+        '''build the index for a list of sequences
+        '''
+        entries = []
+        for identifier, sequence in enumerate(sequences):
+            for position, hashed in minimizers(sequence, self.k, self.w):
+                entries.append((hashed, identifier, position))
+        entries.sort()
+
+        for hashed, identifier, position in entries:
+            if not self.keys or self.keys[-1] != hashed:
+                if self.keys:
+                    self.starts.append(len(self.ids))
+                self.keys.append(hashed)
+            self.ids.append(identifier)
+            self.positions.append(position)
+        self.starts.append(len(self.ids))
+
+    def lookup(self, hashed):
+        '''return (id, position) for the sequences with a minimizer
+        '''
+        index = bisect_left(self.keys, hashed)
+        if index == len(self.keys) or self.keys[index] != hashed:
+            return []
+        start, end = self.starts[index], self.starts[index + 1]
+        return zip(self.ids[start:end], self.positions[start:end])
+
+    def search(self, query, get_sequence, identity=0.95, max_mismatches=None):
+        '''find approximate matches of the indexed sequences in a query,
+           returning a list of (id, start, end).
+
+           Parameters
+           ==========
+           query: the sequence to search, as nucleotide codes (see encode)
+           get_sequence: a function to return an indexed sequence by id, as
+                         a PackedSequence (to verify matches)
+           identity: the minimum fraction of matching letters
+           max_mismatches: if defined, the maximum number of mismatches
+        '''
+        candidates = set()
+        for position, hashed in minimizers(query, self.k, self.w):
+            for identifier, offset in self.lookup(hashed):
+                candidates.add((identifier, position - offset))
+
+        # Matches are verified against the packed sequences
+        packed = PackedQuery(query)
+        matches = []
+        for identifier, start in sorted(candidates, key=lambda x: (x[1], x[0])):
+            sequence = get_sequence(identifier)
+            end = start + len(sequence)
+            if start < 0 or end > len(query):
+                continue
+
+            allowed = int(len(sequence) * (1 - identity))
+            if max_mismatches is not None:
+                allowed = min(allowed, max_mismatches)
+
+            if packed.count_mismatches(sequence, start) <= allowed:
+                matches.append((identifier, start, end))
+        return matches
+
+    def dumps(self):
+        '''serialize the index (compressed) to save it. The arrays are
+           written as bytes after a json header (with their types and
+           lengths), so loading the index doesn't run any code.
+        '''
+        arrays = [self.keys, self.starts, self.ids, self.positions]
+        header = json.dumps({"k": self.k, "w": self.w, "byteorder": sys.byteorder,
+                             "arrays": [[values.typecode, values.itemsize, len(values)]
+                                        for values in arrays]})
+        data = b"".join(values.tobytes() for values in arrays)
+        return zlib.compress(header.encode('utf-8') + b"\n" + data)
+
+    @classmethod
+    def loads(cls, data):
+        '''load an index serialized with dumps, raising a ValueError if the
+           data isn't a valid index (for this platform).
+        '''
+        try:
+            header, data = zlib.decompress(data).split(b"\n", 1)
+            header = json.loads(header.decode('utf-8'))
+        except (zlib.error, ValueError):
+            raise ValueError("The data is not a serialized k-mer index.")
+
+        try:
+            k, w, byteorder = header['k'], header['w'], header['byteorder']
+            types = [(str(typecode), int(itemsize), int(length))
+                     for typecode, itemsize, length in header['arrays']]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("The k-mer index header is not valid.")
+        if [typecode for typecode, _, _ in types] != ["Q", "L", "L", "L"]:
+            raise ValueError("The k-mer index header is not valid.")
+
+        arrays = []
+        offset = 0
+        for typecode, itemsize, length in types:
+            values = array(typecode)
+            if values.itemsize != itemsize:
+                raise ValueError("The k-mer index was saved on another platform.")
+            values.frombytes(data[offset:offset + itemsize * length])
+            if len(values) != length:
+                raise ValueError("The k-mer index is incomplete.")
+            if byteorder != sys.byteorder:
+                values.byteswap()
+            offset += itemsize * length
+            arrays.append(values)
+
+        index = cls(k=int(k), w=int(w))
+        index.keys, index.starts, index.ids, index.positions = arrays
+        return index
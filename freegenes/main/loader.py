@@ -0,0 +1,173 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.logger import bot
+from .records import Record
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class Loader(object):
+    '''A batching loader to resolve the relations of records (see
+       Record.resolve) with an identity map of the records loaded, by
+       entity and uuid. Records bound together (e.g., a listing, or the
+       records resolved for a relation) are a batch, and when a relation
+       of one record is resolved, the uuids it references in every record
+       of the batch are loaded together, and are the next batch. A few
+       uuids are retrieved concurrently (one request each, with
+       client.workers threads), and more than threshold are retrieved with
+       one (paginated) listing of the entity. Walking a tree of relations
+       (e.g., plateset -> plates -> wells -> samples -> parts) then costs a
+       few requests per level, and only loads the records that are walked.
+
+       The identity map keeps the max_size records used most recently, so
+       it doesn't grow without bound in a long running process.
+
+       Parameters
+       ==========
+       client: the client (with records=True) to retrieve records
+       threshold: the number of uuids to load above which we list all
+       max_size: the maximum number of records in the identity map
+    '''
+    def __init__(self, client, threshold=100, max_size=10000):
+        self.client = client
+        self.threshold = threshold
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return "[loader][%s]" % len(self.records)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def bind(self, results):
+        '''bind a record (or a list of records) to the loader, adding them
+           to the identity map, as a batch.
+        '''
+        records = results if isinstance(results, list) else [results]
+        records = [record for record in records
+                   if isinstance(record, Record) and record.entity is not None]
+        with self.lock:
+            for record in records:
+                object.__setattr__(record, "_loader", self)
+                object.__setattr__(record, "_batch", records)
+                uuid = record.get('uuid')
+                if uuid:
+                    self._add(record.entity, uuid, record)
+        return results
+
+    def _add(self, entity, uuid, record):
+        '''add a record to the identity map (with the lock held), removing
+           the least recently used if it's full.
+        '''
+        self.records[(entity, uuid)] = record
+        self.records.move_to_end((entity, uuid))
+        while len(self.records) > self.max_size:
+            self.records.popitem(last=False)
+
+    def _lookup(self, entity, uuids):
+        '''return the records (None if not loaded) for uuids of an entity,
+           with the lock held, and mark them as recently used.
+        '''
+        found = []
+        for uuid in uuids:
+            record = self.records.get((entity, uuid))
+            if record is not None:
+                self.records.move_to_end((entity, uuid))
+            found.append(record)
+        return found
+
+    def resolve(self, record, field):
+        '''return the record(s) referenced by a relation (field) of a
+           record, loading them along with the references of the same field
+           in the records of its batch, which are bound as the next batch.
+        '''
+        entity = record.relations[field]
+        value = record.get(field)
+        uuids = value if isinstance(value, list) else [value]
+
+        batch = getattr(record, "_batch", None) or [record]
+        wanted = []
+        for source in batch:
+            references = source.get(field)
+            for uuid in references if isinstance(references, list) else [references]:
+                if isinstance(uuid, str) and uuid not in wanted:
+                    wanted.append(uuid)
+
+        # The records are returned from the load (they could be evicted)
+        loaded = dict(zip(wanted, self.get_many(entity, wanted)))
+        batch = [found for found in loaded.values() if found is not None]
+        for found in batch:
+            object.__setattr__(found, "_batch", batch)
+
+        records = [loaded.get(uuid) for uuid in uuids]
+        if isinstance(value, list):
+            return records
+        return records[0]
+
+    def get(self, entity, uuid):
+        '''return the record for an entity by uuid, loading it if it isn't
+           loaded.
+        '''
+        return self.get_many(entity, [uuid])[0]
+
+    def get_many(self, entity, uuids):
+        '''return the records for an entity by uuids (None for a record
+           that can't be retrieved), loading any that aren't loaded.
+        '''
+        with self.lock:
+            found = self._lookup(entity, uuids)
+        missing = [uuid for uuid, record in zip(uuids, found) if record is None]
+        if not missing:
+            return found
+
+        loaded = dict(zip(missing, self.load(entity, missing)))
+        return [record if record is not None else loaded[uuid]
+                for uuid, record in zip(uuids, found)]
+
+    def load(self, entity, uuids):
+        '''load records for uuids of an entity, returning them in order
+           (None for a record that can't be retrieved).
+        '''
+        uuids = list(OrderedDict.fromkeys(uuids))
+        if not uuids:
+            return []
+
+        # Records retrieved by the client are bound (and added) by get
+        if len(uuids) > self.threshold:
+            bot.debug("Loading %s %s with a listing." % (len(uuids), entity))
+            results = self.client.get_entity(entity)
+            results = {record.get('uuid'): record for record in results
+                       if isinstance(record, Record)} if isinstance(results, list) else {}
+            records = [results.get(uuid) for uuid in uuids]
+        else:
+            bot.debug("Loading %s %s." % (len(uuids), entity))
+            get = lambda uuid: self.client.get_entity(entity, uuid)
+            with ThreadPoolExecutor(max_workers=self.client.workers) as executor:
+                records = [record if isinstance(record, Record) else None
+                           for record in executor.map(get, uuids)]
+
+        for uuid, record in zip(uuids, records):
+            if record is None:
+                bot.warning("Could not load %s %s" % (entity, uuid))
+        return records
+
+    def clear(self, entity=None):
+        '''clear the identity map (for an entity, or all if None).
+        '''
+        with self.lock:
+            if entity is None:
+                self.records = OrderedDict()
+            else:
+                for key in [key for key in self.records if key[0] == entity]:
+                    del self.records[key]
@@ -0,0 +1,277 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.logger import bot
+from .cache import get_newest
+from .entities import ENTITIES
+from .records import RECORDS, record_default
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import datetime
+import json
+import os
+import re
+import sqlite3
+
+# Entities to mirror, the endpoints of the API (wells don't have functions)
+MIRROR_ENTITIES = [endpoint for endpoint, plural, singular in ENTITIES] + ["wells"]
+
+
+class Mirror(object):
+    '''A local snapshot of the FreeGenes database, stored as sqlite. All
+       entities are stored in one table of records (entity, uuid, and the
+       json data), with a view for each entity, so they can be queried with
+       the json functions of sqlite:
+
+       SELECT uuid, json_extract(data, '$.name') FROM parts;
+
+       References between entities (see the relations of each record) are
+       stored in a table of refs, indexed by source and by target, e.g.,
+       the samples for a part:
+
+       SELECT uuid FROM refs WHERE target = 'parts' AND target_uuid = ?;
+
+       Parameters
+       ==========
+       path: the path to the sqlite database (created if it doesn't exist)
+    '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS records "
+                         "(entity TEXT, uuid TEXT, time_updated TEXT, data TEXT, "
+                         "PRIMARY KEY (entity, uuid))")
+            conn.execute("CREATE INDEX IF NOT EXISTS records_uuid ON records (uuid)")
+            conn.execute("CREATE TABLE IF NOT EXISTS refs "
+                         "(entity TEXT, uuid TEXT, field TEXT, target TEXT, target_uuid TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS refs_source ON refs (entity, uuid)")
+            conn.execute("CREATE INDEX IF NOT EXISTS refs_target ON refs (target, target_uuid)")
+            conn.execute("CREATE TABLE IF NOT EXISTS syncs "
+                         "(entity TEXT PRIMARY KEY, watermark TEXT, count INTEGER, "
+                         "time_synced TEXT)")
+
+    def __str__(self):
+        return "[mirror][%s]" % self.path
+
+    def __repr__(self):
+        return self.__str__()
+
+    @contextmanager
+    def _connect(self):
+        '''yield a connection to the database, committing on success and
+           always closing it.
+        '''
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def count(self, entity):
+        '''return the number of records for an entity.
+        '''
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM records WHERE entity = ?",
+                                (entity,)).fetchone()[0]
+
+    def get_watermark(self, entity):
+        '''return the newest modification time of an entity at the last
+           sync, or None if it wasn't synced (or doesn't have times).
+        '''
+        with self._connect() as conn:
+            row = conn.execute("SELECT watermark FROM syncs WHERE entity = ?",
+                               (entity,)).fetchone()
+        if row:
+            return row[0]
+
+    def is_synced(self, entity):
+        '''determine if an entity was mirrored (even if it has no records).
+        '''
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM syncs WHERE entity = ?",
+                                (entity,)).fetchone()[0] > 0
+
+    def list(self, entity):
+        '''return all records (dictionaries) for an entity.
+        '''
+        with self._connect() as conn:
+            rows = conn.execute("SELECT data FROM records WHERE entity = ?",
+                                (entity,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get(self, entity, uuid):
+        '''return a record (dictionary) by entity and uuid, or None.
+        '''
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM records WHERE entity = ? AND uuid = ?",
+                               (entity, uuid)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def query(self, sql, params=None):
+        '''run a query on the mirror, returning a list of rows.
+        '''
+        with self._connect() as conn:
+            return conn.execute(sql, params or []).fetchall()
+
+    def save(self, entity, records, replace=False):
+        '''save records for an entity, replacing records with the same uuid
+           (or all records for the entity, if replace is True), along with
+           their references, and update the watermark for the entity.
+        '''
+        return self.save_pages(entity, [records], replace)
+
+    def save_pages(self, entity, pages, replace=False):
+        '''like save, for an iterable of pages (lists of records) that are
+           saved as they are retrieved, so a large listing isn't held in
+           memory. Each page is saved in a short transaction (so entities
+           can be saved concurrently), and if replace is True, records that
+           weren't in any page are removed once all pages are saved. The
+           sync (watermark) is only updated once all pages are saved. We
+           return the number of records saved.
+        '''
+        if entity not in MIRROR_ENTITIES:
+            raise ValueError("%s is not an entity that can be mirrored." % entity)
+
+        saved = 0
+        seen = set()
+        for records in pages:
+            with self._connect() as conn:
+                seen.update(self._save_page(conn, entity, records))
+            saved += len(records)
+
+        with self._connect() as conn:
+            if replace:
+                stale = [(entity, row[0]) for row in conn.execute(
+                    "SELECT uuid FROM records WHERE entity = ?", (entity,)) if row[0] not in seen]
+                conn.executemany("DELETE FROM records WHERE entity = ? AND uuid = ?", stale)
+                conn.executemany("DELETE FROM refs WHERE entity = ? AND uuid = ?", stale)
+            conn.execute('CREATE VIEW IF NOT EXISTS "%s" AS SELECT uuid, time_updated, data '
+                         'FROM records WHERE entity = \'%s\'' % (entity, entity))
+
+            # Only entities with modification times for all records can resync,
+            # times are compared as dates (their offsets can differ)
+            times = [row[0] for row in conn.execute(
+                "SELECT time_updated FROM records WHERE entity = ?", (entity,))]
+            watermark = get_newest(times)
+            count = len(times)
+            conn.execute("INSERT OR REPLACE INTO syncs (entity, watermark, count, time_synced) "
+                         "VALUES (?, ?, ?, ?)", (entity, watermark, count,
+                                                 datetime.datetime.now().isoformat()))
+        return saved
+
+    def _save_page(self, conn, entity, records):
+        '''save a page of records (and their references) with a connection,
+           returning the uuids saved.
+        '''
+        relations = getattr(RECORDS.get(entity), "relations", {})
+        rows = []
+        refs = []
+        for record in records:
+            uuid = record.get('uuid')
+            rows.append((entity, uuid, record.get('time_updated'),
+                         json.dumps(record, default=record_default)))
+            for field, target in relations.items():
+                value = record.get(field)
+                for target_uuid in value if isinstance(value, list) else [value]:
+                    if isinstance(target_uuid, str):
+                        refs.append((entity, uuid, field, target, target_uuid))
+
+        conn.executemany("DELETE FROM refs WHERE entity = ? AND uuid = ?",
+                         [row[:2] for row in rows])
+        conn.executemany("INSERT OR REPLACE INTO records (entity, uuid, time_updated, data) "
+                         "VALUES (?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO refs (entity, uuid, field, target, target_uuid) "
+                         "VALUES (?, ?, ?, ?, ?)", refs)
+        return [row[1] for row in rows]
+
+
+def mirror(self, path, entities=None, workers=None, full=False):
+    '''mirror the FreeGenes database to a local sqlite database (see
+       Mirror), downloading entities concurrently. If an entity was already
+       mirrored (and has modification times), only the records modified
+       since the last sync are retrieved, unless the count of records on
+       the server doesn't match (records were deleted), then all records
+       are retrieved again.
+
+       Parameters
+       ==========
+       path: the path to the sqlite database
+       entities: a list of entities (endpoints) to mirror (default all, see
+                 MIRROR_ENTITIES)
+       workers: the number of entities to download at once (self.workers)
+       full: if True, retrieve all records (not only modified ones)
+
+       Returns
+       =======
+       a lookup of entity -> the number of records retrieved
+    '''
+    entities = entities or MIRROR_ENTITIES
+    unknown = [entity for entity in entities if entity not in MIRROR_ENTITIES]
+    if unknown:
+        bot.exit("Cannot mirror %s, choices are: %s" %(", ".join(unknown),
+                                                       ", ".join(MIRROR_ENTITIES)))
+    snapshot = Mirror(path)
+
+    # Each entity has at most one page request in flight
+    workers = workers or self.workers
+    self.session.reserve(workers)
+
+    def sync(entity):
+        return self._mirror_entity(snapshot, entity, full)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        counts = dict(zip(entities, executor.map(sync, entities)))
+    return counts
+
+
+def get_mirrored(self, url):
+    '''return the results of a get (a listing or a record of an entity)
+       from the client's mirror (snapshot), or None if the entity isn't
+       mirrored or the record isn't found. Query parameters are ignored.
+    '''
+    match = re.search("/api/([^/?]+)/?([^/?]*)", url)
+    if self.snapshot is None or not match:
+        return None
+
+    entity, uuid = match.groups()
+    if not self.snapshot.is_synced(entity):
+        return None
+    if uuid:
+        return self.snapshot.get(entity, uuid)
+    return self.snapshot.list(entity)
+
+
+def mirror_entity(self, snapshot, entity, full=False):
+    '''sync one entity to a mirror, returning the number of records
+       retrieved (see mirror).
+    '''
+    watermark = None if full else snapshot.get_watermark(entity)
+
+    if watermark is not None:
+        records, count = self._get_modified(entity, watermark)
+        snapshot.save(entity, records)
+        if count is not None and count == snapshot.count(entity):
+            bot.debug("Synced %s modified %s" % (len(records), entity))
+            return len(records)
+
+    # Pages are saved as they are retrieved, and the sync isn't updated if
+    # one fails (a page error exits, after logging it)
+    try:
+        count = snapshot.save_pages(entity, self._iter_pages('/api/%s/' % entity), replace=True)
+    except SystemExit:
+        bot.warning("Cannot mirror %s, skipping." % entity)
+        return 0
+
+    bot.debug("Mirrored %s %s" % (count, entity))
+    return count
@@ -0,0 +1,123 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.logger import bot
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+
+
+def page_urls(next_url, count, size):
+    '''given the url for the next page, the total count of results, and
+       the size of the first page, return the urls for all remaining pages.
+       We support limit/offset and page number pagination, and return
+       None if the next url doesn't have either.
+
+       Parameters
+       ==========
+       next_url: the url of the next page provided by the first response
+       count: the total number of results
+       size: the number of results in the first page
+    '''
+    parsed = urlparse(next_url)
+    params = parse_qs(parsed.query)
+
+    def with_param(name, value):
+        params[name] = [value]
+        return urlunparse(parsed._replace(query=urlencode(params, doseq=True)))
+
+    if "offset" in params:
+        offset = int(params['offset'][0])
+        limit = int(params.get('limit', [size])[0])
+        if limit <= 0:
+            return None
+        return [with_param("offset", start) for start in range(offset, count, limit)]
+
+    if "page" in params:
+        page = int(params['page'][0])
+        if size <= 0:
+            return None
+        last = (count + size - 1) // size
+        return [with_param("page", number) for number in range(page, last + 1)]
+
+
+def get_pages(self, response, headers, results):
+    '''given the first page of a listing (the parsed response), retrieve
+       all remaining pages and add them to results. If the response has a
+       count, we prepare the urls for all pages and retrieve them
+       concurrently with self.workers threads, otherwise we follow the
+       next links.
+
+       Parameters
+       ==========
+       response: the parsed json of the first page, with next
+       headers: the headers to use for the requests
+       results: the results of the first page, extended in place
+    '''
+    next_url = response.get('next')
+    urls = None
+    if response.get('count') is not None:
+        urls = page_urls(next_url, response['count'], len(results))
+
+    if urls:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for page in executor.map(lambda url: self._get_page(url, headers), urls):
+                results.extend(page['results'])
+        return results
+
+    while next_url:
+        page = self._get_page(next_url, headers)
+        results.extend(page['results'])
+        next_url = page.get('next')
+    return results
+
+
+def get_page(self, url, headers):
+    '''retrieve a single page of a listing (a complete url), and exit on
+       error, since the results would otherwise be incomplete.
+    '''
+    self._check_request(url)
+    response = self.session.get(url, headers=headers)
+    if response.status_code != 200:
+        bot.exit("Error with %s, return value %s: %s" %(url, response.status_code, response.reason))
+    return response.json()
+
+
+def iter_pages(self, url, headers=None, limit=1000, prefetch=True):
+    '''yield the results of a listing one page at a time, so the caller
+       can process a large listing without holding it in memory. If
+       prefetch is True, the next page is retrieved in the background
+       while the current one is processed.
+
+       Parameters
+       ==========
+       url: the url endpoint to query (without the http/s or domain)
+       headers: if defined, don't use default headers.
+       limit: number of responses per page (default 1000)
+       prefetch: retrieve the next page while yielding the current
+    '''
+    heads = headers or self.headers
+    next_url = "%s?limit=%s" %(self._prepare_url(url), limit)
+
+    if not prefetch:
+        while next_url:
+            page = self._get_page(next_url, heads)
+            next_url = page.get('next')
+            yield page.get('results', [])
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(self._get_page, next_url, heads)
+        while future is not None:
+            page = future.result()
+            future = None
+            if page.get('next'):
+                future = executor.submit(self._get_page, page['next'], heads)
+            yield page.get('results', [])
@@ -0,0 +1,171 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.utils import mkdir_p
+from freegenes.logger import bot
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+
+class PlatemapCache(object):
+    '''An on-disk cache of parsed Twist plate maps. The plate map for an
+       order (sfdc_id) and barcode doesn't change once it's produced, so
+       entries never expire, and the cache is only bounded in size (the
+       least recently used plate maps are removed first). Rows are stored
+       content addressed (by the hash of the rows) as gzipped json lines,
+       so they can be written and read as a stream, and a small key file
+       for each (base, sfdc_id, barcode) points to the content.
+
+       Parameters
+       ==========
+       cache_dir: the directory for the cache (twist-platemaps is created)
+       max_size: the maximum size (bytes) of the cached plate maps
+    '''
+    def __init__(self, cache_dir, max_size=256 * 1024 * 1024):
+        self.root = os.path.join(cache_dir, "twist-platemaps")
+        self.objects = os.path.join(self.root, "objects")
+        self.keys = os.path.join(self.root, "keys")
+        self.orders = os.path.join(self.root, "orders")
+        self.max_size = max_size
+        mkdir_p(self.objects)
+        mkdir_p(self.keys)
+        mkdir_p(self.orders)
+
+    def __str__(self):
+        return "[platemap-cache][%s]" % self.root
+
+    def __repr__(self):
+        return self.__str__()
+
+    def _key_path(self, base, sfdc_id, barcode):
+        key = json.dumps([base, sfdc_id, barcode])
+        return os.path.join(self.keys, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, base, sfdc_id, barcode):
+        '''return the path to the cached rows for a plate map, or None if
+           it's not cached. The access time is updated for eviction.
+        '''
+        try:
+            with open(self._key_path(base, sfdc_id, barcode)) as filey:
+                path = os.path.join(self.objects, filey.read().strip())
+            os.utime(path)
+        except (IOError, OSError):
+            return None
+        return path
+
+    def _order_path(self, base, sfdc_id):
+        key = json.dumps([base, sfdc_id])
+        return os.path.join(self.orders, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get_barcodes(self, base, sfdc_id):
+        '''return the container barcodes saved for a complete order, or None
+           if they aren't saved.
+        '''
+        try:
+            with open(self._order_path(base, sfdc_id)) as filey:
+                return json.load(filey)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save_barcodes(self, base, sfdc_id, barcodes):
+        '''save the container barcodes for a complete order (all shipments
+           received), so the order items don't need to be retrieved again.
+        '''
+        self._write(self._order_path(base, sfdc_id), json.dumps(barcodes))
+
+    def iter_rows(self, path):
+        '''yield the rows of a cached plate map.
+        '''
+        with gzip.open(path, 'rt') as filey:
+            for line in filey:
+                yield json.loads(line)
+
+    def save(self, base, sfdc_id, barcode, rows):
+        '''yield rows (e.g., as they are downloaded) while writing them to
+           the cache. The plate map is only added once all rows are read.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.objects, suffix=".tmp")
+        os.close(fd)
+        digest = hashlib.sha256()
+        complete = False
+        try:
+            with gzip.open(tmp, 'wt') as filey:
+                for row in rows:
+                    line = json.dumps(row) + "\n"
+                    digest.update(line.encode('utf-8'))
+                    filey.write(line)
+                    yield row
+            complete = True
+        finally:
+            if not complete:
+                os.remove(tmp)
+
+        content = digest.hexdigest()
+        os.replace(tmp, os.path.join(self.objects, content))
+
+        self._write(self._key_path(base, sfdc_id, barcode), content)
+        self.evict()
+
+    def _write(self, path, content):
+        '''write a (small) file, replaced so a reader never sees it partial.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, 'w') as filey:
+            filey.write(content)
+        os.replace(tmp, path)
+
+    def evict(self):
+        '''remove the least recently used plate maps (and their keys) until
+           the cache is within max_size.
+        '''
+        # Another thread (or process) can evict or replace files as we go
+        objects = []
+        for name in os.listdir(self.objects):
+            if not name.endswith(".tmp"):
+                try:
+                    stat = os.stat(os.path.join(self.objects, name))
+                except OSError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in objects)
+        if size <= self.max_size:
+            return
+
+        removed = set()
+        for mtime, filesize, name in sorted(objects):
+            if size <= self.max_size:
+                break
+            removed.add(name)
+            size -= filesize
+            self._remove(os.path.join(self.objects, name))
+
+        for name in os.listdir(self.keys):
+            path = os.path.join(self.keys, name)
+            if not name.endswith(".tmp"):
+                try:
+                    with open(path) as filey:
+                        content = filey.read().strip()
+                except (IOError, OSError):
+                    continue
+                if content in removed:
+                    self._remove(path)
+        bot.debug("Removed %s plate maps from %s" % (len(removed), self.root))
+
+    def _remove(self, path):
+        # Another process could have removed it
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,402 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+import json
+import zlib
+
+
+def record_slots(fields, heavy=()):
+    '''return the __slots__ for a record class, heavy fields are stored
+       (compressed) in a slot with a leading underscore.
+    '''
+    return tuple("_%s" % field if field in heavy else field for field in fields)
+
+
+class Record(object):
+    '''A compact record for an entity returned by the API. Fields are
+       stored in __slots__ (instead of a dictionary per record), fields
+       not known for the entity are kept in _extra, and heavy fields that
+       are rarely used (e.g., genbank) are kept compressed and only parsed
+       when accessed. A record can be used like the dictionary it was
+       created from (record['uuid'], record.get('name'), dict(record)).
+
+       Fields that reference other entities by uuid (relations) can be
+       resolved to records if the record is bound to a Loader (records
+       returned by a Client with records=True are).
+
+       Usage:
+       =====
+       part = Part({"uuid": "...", "genbank": {...}})
+       part.uuid
+       part['genbank']  # decompressed and parsed
+       part.resolve('author')  # an Author record
+    '''
+    __slots__ = ('_extra', '_loader', '_batch')
+    entity = None
+    fields = ()
+    heavy = ()
+    relations = {}
+
+    def __init__(self, data=None):
+        data = dict(data or {})
+        for field in self.fields:
+            if field in data:
+                self[field] = data.pop(field)
+        self._extra = data or None
+
+    def __getattr__(self, name):
+        # Only called if the attribute isn't found, e.g., a heavy field
+        if name in self.heavy:
+            value = object.__getattribute__(self, "_%s" % name)
+            if value is not None:
+                value = json.loads(zlib.decompress(value).decode('utf-8'))
+            return value
+        raise AttributeError(name)
+
+    def __setitem__(self, key, value):
+        if key in self.heavy:
+            if value is not None:
+                value = zlib.compress(json.dumps(value).encode('utf-8'))
+            object.__setattr__(self, "_%s" % key, value)
+        elif key in self.fields:
+            object.__setattr__(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self._get_slot(key)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "[%s][%s]" % (self.__class__.__name__.lower(), self.get('uuid'))
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __getstate__(self):
+        return {slot: object.__getattribute__(self, slot)
+                for slot in record_slots(self.fields, self.heavy) + ('_extra',)
+                if hasattr(self, slot)}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            object.__setattr__(self, slot, value)
+
+    def _get_slot(self, key):
+        '''return the stored value for a key (a heavy field is returned
+           compressed), raising a KeyError if it's not defined.
+        '''
+        if key in self.fields:
+            slot = "_%s" % key if key in self.heavy else key
+            try:
+                return object.__getattribute__(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def resolve(self, field):
+        '''resolve a relation (a field with one or a list of uuids) to
+           the record(s) it references, loaded by the bound Loader.
+        '''
+        if field not in self.relations:
+            raise KeyError("%s is not a relation of %s" % (field, self.entity))
+        try:
+            loader = object.__getattribute__(self, "_loader")
+        except AttributeError:
+            raise ValueError("%s is not bound to a loader to resolve %s" % (self, field))
+
+        if self.get(field) is None:
+            return None
+        return loader.resolve(self, field)
+
+    def references(self):
+        '''yield (entity, uuid) for each uuid referenced by a relation.
+        '''
+        for field, entity in self.relations.items():
+            value = self.get(field)
+            if isinstance(value, list):
+                for uuid in value:
+                    if isinstance(uuid, str):
+                        yield entity, uuid
+            elif isinstance(value, str):
+                yield entity, value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [field for field in self.fields if field in self]
+        return keys + list(self._extra or [])
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        '''return the record as a dictionary (heavy fields are parsed).
+        '''
+        return dict(self.items())
+
+
+# Records for the FreeGenes entities, fields are from the API
+
+class Author(Record):
+    entity = "authors"
+    relations = {"tags": "tags"}
+    fields = ("uuid", "name", "email", "affiliation", "orcid", "tags", "label")
+    __slots__ = record_slots(fields)
+
+
+class Collection(Record):
+    entity = "collections"
+    relations = {"parent": "collections", "tags": "tags"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "parent", "tags", "label")
+    __slots__ = record_slots(fields)
+
+
+class CompositePart(Record):
+    entity = "compositeparts"
+    relations = {"parts": "parts"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "composite_id", "composite_type", "direction_string", "sequence",
+              "parts", "label")
+    heavy = ("sequence",)
+    __slots__ = record_slots(fields, heavy)
+
+
+class Container(Record):
+    entity = "containers"
+    relations = {"parent": "containers", "plates": "plates"}
+    fields = ("uuid", "time_created", "time_updated", "name", "container_type",
+              "description", "estimated_temperature", "x", "y", "z", "parent",
+              "plates", "label")
+    __slots__ = record_slots(fields)
+
+
+class Distribution(Record):
+    entity = "distributions"
+    relations = {"platesets": "platesets"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "platesets", "label")
+    __slots__ = record_slots(fields)
+
+
+class Institution(Record):
+    entity = "institutions"
+    fields = ("uuid", "name", "signed_master", "label")
+    __slots__ = record_slots(fields)
+
+
+class Module(Record):
+    entity = "modules"
+    relations = {"container": "containers"}
+    fields = ("uuid", "time_created", "time_updated", "name", "container",
+              "notes", "model_id", "module_type", "data", "label")
+    heavy = ("data",)
+    __slots__ = record_slots(fields, heavy)
+
+
+class Operation(Record):
+    entity = "operations"
+    relations = {"plans": "plans"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "plans", "label")
+    __slots__ = record_slots(fields)
+
+
+class Order(Record):
+    entity = "orders"
+    relations = {"distributions": "distributions"}
+    fields = ("uuid", "time_created", "time_updated", "name", "notes",
+              "distributions", "label")
+    __slots__ = record_slots(fields)
+
+
+class Organism(Record):
+    entity = "organisms"
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "genotype", "label")
+    __slots__ = record_slots(fields)
+
+
+class Part(Record):
+    entity = "parts"
+    relations = {"author": "authors", "tags": "tags", "collections": "collections"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "status", "gene_id", "part_type", "genbank", "original_sequence",
+              "optimized_sequence", "synthesized_sequence", "full_sequence",
+              "vector", "primer_forward", "primer_reverse", "barcode", "label",
+              "translation", "tags", "collections", "author")
+    heavy = ("genbank", "original_sequence", "synthesized_sequence",
+             "full_sequence", "translation")
+    __slots__ = record_slots(fields, heavy)
+
+
+class Plan(Record):
+    entity = "plans"
+    relations = {"parent": "plans", "operation": "operations"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "parent", "operation", "status", "label")
+    __slots__ = record_slots(fields)
+
+
+class Plate(Record):
+    entity = "plates"
+    relations = {"container": "containers", "protocol": "protocols", "wells": "wells"}
+    fields = ("uuid", "time_created", "time_updated", "plate_type", "plate_form",
+              "status", "name", "thaw_count", "notes", "height", "length",
+              "container", "protocol", "wells", "label")
+    __slots__ = record_slots(fields)
+
+
+class PlateSet(Record):
+    entity = "platesets"
+    relations = {"plates": "plates"}
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "plates", "label")
+    __slots__ = record_slots(fields)
+
+
+class Protocol(Record):
+    entity = "protocols"
+    relations = {"schema": "schemas"}
+    fields = ("uuid", "time_created", "time_updated", "description", "data",
+              "schema", "label")
+    heavy = ("data",)
+    __slots__ = record_slots(fields, heavy)
+
+
+class Robot(Record):
+    entity = "robots"
+    relations = {"container": "containers"}
+    fields = ("uuid", "time_created", "time_updated", "name", "container",
+              "notes", "server_version", "robot_id", "robot_type", "label")
+    __slots__ = record_slots(fields)
+
+
+class Sample(Record):
+    entity = "samples"
+    relations = {"part": "parts", "derived_from": "samples", "wells": "wells"}
+    fields = ("uuid", "time_created", "time_updated", "outside_collaborator",
+              "sample_type", "status", "evidence", "vendor", "derived_from",
+              "part", "index_forward", "index_reverse", "wells", "label")
+    __slots__ = record_slots(fields)
+
+
+class Schema(Record):
+    entity = "schemas"
+    fields = ("uuid", "time_created", "time_updated", "name", "description",
+              "schema", "label")
+    heavy = ("schema",)
+    __slots__ = record_slots(fields, heavy)
+
+
+class Well(Record):
+    entity = "wells"
+    relations = {"organism": "organisms", "samples": "samples"}
+    fields = ("uuid", "time_created", "time_updated", "address", "volume",
+              "quantity", "media", "organism", "samples", "label")
+    __slots__ = record_slots(fields)
+
+
+class Tag(Record):
+    entity = "tags"
+    fields = ("uuid", "tag", "value", "label")
+    __slots__ = record_slots(fields)
+
+
+# Record classes by endpoint (see ENTITIES)
+
+RECORDS = {
+    "authors": Author,
+    "collections": Collection,
+    "compositeparts": CompositePart,
+    "containers": Container,
+    "distributions": Distribution,
+    "institutions": Institution,
+    "modules": Module,
+    "operations": Operation,
+    "orders": Order,
+    "organisms": Organism,
+    "parts": Part,
+    "plans": Plan,
+    "plates": Plate,
+    "platesets": PlateSet,
+    "protocols": Protocol,
+    "robots": Robot,
+    "samples": Sample,
+    "schemas": Schema,
+    "tags": Tag,
+    "wells": Well,
+}
+
+
+def to_records(results, entity):
+    '''convert the results of a get for an entity (a record or a listing
+       of records) to record instances, if there is a record class for it.
+    '''
+    record = RECORDS.get(entity)
+    if record is None:
+        return results
+    if isinstance(results, dict):
+        return record(results)
+    if isinstance(results, list):
+        return [record(result) if isinstance(result, dict) else result for result in results]
+    return results
+
+
+def record_default(value):
+    '''a default for json.dumps, to serialize records as dictionaries.
+    '''
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError("%s is not JSON serializable" % type(value).__name__)
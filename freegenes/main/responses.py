@@ -0,0 +1,115 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from collections import OrderedDict
+import json
+import re
+import threading
+import time
+
+
+def get_url_entity(url):
+    '''return the entity (the endpoint name, e.g., parts) of an api url,
+       partial (/api/parts/) or complete, or None if it's not an api url.
+    '''
+    match = re.search("/api/([^/?]+)", url)
+    if match:
+        return match.group(1)
+
+
+class ResponseCache(object):
+    '''A cache of responses for Client.get, bounded in size (the least
+       recently used responses are removed first) with a time to live per
+       entity. Responses are stored as json, so a caller can change a
+       response without changing the cache. Writes to an entity (create,
+       update, patch, delete) invalidate all of its responses.
+
+       Usage:
+       =====
+       cache = ResponseCache(ttl=300, ttls={"tags": 3600, "plates": 30})
+       client = Client(response_cache=cache)
+       client.get_tags()
+       cache.stats()  # {'hits': 0, 'misses': 1, 'size': 1}
+
+       Parameters
+       ==========
+       maxsize: the maximum number of responses to keep
+       ttl: the default time (seconds) to keep a response (None is forever)
+       ttls: a lookup of entity -> time to live, 0 is to not cache it
+    '''
+    def __init__(self, maxsize=1024, ttl=300, ttls=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.responses)
+
+    def __str__(self):
+        return "[response-cache][%s]" % len(self)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_ttl(self, entity):
+        '''return the time to live for an entity's responses.
+        '''
+        return self.ttls.get(entity, self.ttl)
+
+    def get(self, key):
+        '''return a cached response, or None if it's not cached (or expired).
+        '''
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None and cached[0] is not None and cached[0] < time.monotonic():
+                del self.responses[key]
+                cached = None
+
+            if cached is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.responses.move_to_end(key)
+        return json.loads(cached[2])
+
+    def set(self, key, entity, response):
+        '''cache a response for an entity, unless its time to live is 0.
+        '''
+        ttl = self.get_ttl(entity)
+        if ttl == 0:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        data = json.dumps(response)
+
+        with self.lock:
+            self.responses[key] = (expires, entity, data)
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.maxsize:
+                self.responses.popitem(last=False)
+
+    def invalidate(self, entity=None):
+        '''remove the cached responses for an entity (or all if None).
+        '''
+        with self.lock:
+            if entity is None:
+                self.responses.clear()
+                return
+            for key in [key for key, cached in self.responses.items() if cached[1] == entity]:
+                del self.responses[key]
+
+    def stats(self):
+        '''return the hits, misses, and number of cached responses.
+        '''
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
@@ -0,0 +1,240 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.logger import bot
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
+from email.utils import parsedate_to_datetime
+import datetime
+import random
+import requests
+import threading
+import time
+
+# Responses that are retried, and those that are safe to retry for any
+# method (the server did not process the request)
+RETRY_STATUS = [429, 502, 503, 504]
+RETRY_ANY_METHOD_STATUS = [429, 503]
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+
+class Session(requests.Session):
+    '''A requests session shared by all calls of a client, so connections
+       to the server are pooled and kept alive instead of opening a new
+       connection (and TLS handshake) for every request. Requests share a
+       rate limiter, and throttled (429) or unavailable (5xx) responses
+       are retried with jittered exponential backoff, honoring Retry-After.
+
+       Parameters
+       ==========
+       pool_size: the maximum number of connections to keep per host (it
+                  grows with reserve, for functions with more concurrency)
+       retries: the number of retries for connection errors and for
+                429, 502, 503, and 504 responses
+       keep_alive: if False, ask the server to close each connection
+       rate: the maximum number of requests per second (None is no limit
+             until the server pushes back)
+       backoff: the base (seconds) of the exponential backoff
+       max_backoff: the maximum time (seconds) to wait between retries
+    '''
+    def __init__(self, pool_size=10, retries=3, keep_alive=True, rate=None,
+                       backoff=0.5, max_backoff=60):
+        super(Session, self).__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(rate)
+        self.pool_lock = threading.Lock()
+        self._mount(pool_size)
+
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+
+    def _mount(self, pool_size):
+        '''mount an adapter with a pool of connections of pool_size.
+        '''
+        # The adapter only retries connection errors, we handle responses
+        retry = Retry(total=self.retries,
+                      read=0,
+                      status=0,
+                      backoff_factor=self.backoff,
+                      raise_on_status=False)
+
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self.pool_size = pool_size
+
+    def reserve(self, concurrency):
+        '''grow the pool of connections (if needed) for a number of
+           concurrent requests, so connections beyond the pool size aren't
+           opened and discarded for each request.
+        '''
+        with self.pool_lock:
+            if concurrency > self.pool_size:
+                bot.debug("Growing connection pool to %s." % concurrency)
+                self._mount(concurrency)
+
+    def request(self, method, url, *args, **kwargs):
+        '''perform a request after waiting for the rate limiter, and retry
+           if the server responds that it's throttling or unavailable.
+        '''
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = super(Session, self).request(method, url, *args, **kwargs)
+
+            if not self._should_retry(method, response, attempt):
+                if response.status_code < 500 and response.status_code != 429:
+                    self.limiter.speed_up()
+                return response
+
+            self.limiter.slow_down()
+            delay = self._get_delay(response, attempt)
+            bot.debug("Return value %s for %s, retrying in %.2f seconds." %(response.status_code,
+                                                                            url, delay))
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _should_retry(self, method, response, attempt):
+        return attempt < self.retries and is_retryable(method, response.status_code)
+
+    def _get_delay(self, response, attempt):
+        return get_delay(response, attempt, self.backoff, self.max_backoff)
+
+
+def is_retryable(method, status):
+    '''determine if a response (status) for a request method can be
+       retried, if the server is throttling or unavailable.
+    '''
+    if status not in RETRY_STATUS:
+        return False
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    return status in RETRY_ANY_METHOD_STATUS
+
+
+def get_delay(response, attempt, backoff=0.5, max_backoff=60):
+    '''the time to wait before a retry, the Retry-After header if the
+       server provides it (with a response), otherwise exponential backoff
+       with jitter.
+    '''
+    delay = None
+    if response is not None:
+        delay = get_retry_after(response)
+    if delay is None:
+        delay = random.uniform(0, backoff * (2 ** attempt))
+    return min(delay, max_backoff)
+
+
+def get_retry_after(response):
+    '''parse the Retry-After header of a response (seconds or a date),
+       returning None if it's not defined or can't be parsed.
+    '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+        now = datetime.datetime.now(date.tzinfo)
+        return max(0, (date - now).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    '''A token bucket shared by threads, to limit the rate of requests.
+       Tokens are added at rate per second, up to burst, and each request
+       takes one (waiting until one is available). The rate adapts, it's
+       halved when the server pushes back (slow_down) and increases by
+       about one request per second for each second of successful requests
+       (speed_up) until it's back to the limit. Without a limit, requests
+       are not limited until the server pushes back.
+
+       Parameters
+       ==========
+       rate: the number of requests per second (None is no limit)
+       burst: the maximum number of requests that can be made at once
+       minimum: the minimum rate when slowing down
+    '''
+    def __init__(self, rate=None, burst=None, minimum=1.0):
+        self.limit = float(rate) if rate else None
+        self.rate = self.limit
+        self.ceiling = self.limit
+        self.minimum = minimum
+        self.fixed_burst = burst
+        self.burst = burst or max(1, int(rate or 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.recent = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''wait until a token is available, and take it.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                # Without a rate, keep track of the requests in the last second
+                if self.rate is None:
+                    self.recent.append(now)
+                    while self.recent and self.recent[0] < now - 1:
+                        self.recent.popleft()
+                    return
+
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        '''halve the rate, starting from the current rate of requests if
+           there isn't one.
+        '''
+        with self.lock:
+            current = self.rate
+            if current is None:
+                current = max(float(len(self.recent)), self.minimum)
+                self.ceiling = current
+                self.tokens = 1
+                self.updated = time.monotonic()
+            self._set_rate(max(self.minimum, current / 2.0))
+            self.tokens = min(self.tokens, 1)
+
+    def speed_up(self):
+        '''increase the rate after a successful request, up to the limit.
+        '''
+        if self.rate is None or self.rate == self.limit:
+            return
+        with self.lock:
+            if self.rate is None:
+                return
+            rate = self.rate + 1.0 / max(self.rate, 1.0)
+            if rate >= self.ceiling:
+                self._set_rate(self.limit)
+            else:
+                self._set_rate(rate)
+
+    def _set_rate(self, rate):
+        self.rate = rate
+        if rate is not None and not self.fixed_burst:
+            self.burst = max(1, int(rate))
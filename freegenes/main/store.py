@@ -0,0 +1,175 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from freegenes.utils import mkdir_p
+from freegenes.logger import bot
+from .records import record_default
+
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import sqlite3
+import zlib
+
+
+class PartsStore(object):
+    '''A persistent parts cache, stored as a sqlite database with one
+       compressed json record per part (keyed by uuid) and a metadata
+       table for the validators (etag, last modified, watermark) used to
+       check the cache against the server. There is one database per
+       server base, so multiple nodes can share a cache directory. Data
+       derived from the parts (blobs, and results by key) is saved with a
+       fingerprint of the parts, and results are cleared when parts are.
+    '''
+    def __init__(self, cache_dir, base):
+        mkdir_p(cache_dir)
+        digest = hashlib.sha1(base.encode('utf-8')).hexdigest()[:12]
+        self.path = os.path.join(cache_dir, "parts-%s.db" % digest)
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS parts "
+                         "(uuid TEXT PRIMARY KEY, data BLOB)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                         "(key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs "
+                         "(key TEXT PRIMARY KEY, fingerprint TEXT, data BLOB)")
+            conn.execute("CREATE TABLE IF NOT EXISTS results "
+                         "(key TEXT PRIMARY KEY, fingerprint TEXT, data BLOB)")
+
+    def __str__(self):
+        return "[store][%s]" % self.path
+
+    def __repr__(self):
+        return self.__str__()
+
+    @contextmanager
+    def _connect(self):
+        '''yield a connection to the database, committing on success and
+           always closing it.
+        '''
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM parts").fetchone()[0]
+
+    def load(self):
+        '''load all parts from the store, returning a lookup by uuid.
+        '''
+        with self._connect() as conn:
+            rows = conn.execute("SELECT uuid, data FROM parts").fetchall()
+        return {uuid: json.loads(zlib.decompress(data).decode('utf-8'))
+                for uuid, data in rows}
+
+    def save(self, parts, meta=None):
+        '''replace the parts in the store, along with any metadata.
+
+           Parameters
+           ==========
+           parts: a lookup of parts, by uuid
+           meta: a dictionary of metadata (e.g., validators) to save
+        '''
+        rows = [(uuid, self._compress(part)) for uuid, part in parts.items()]
+        with self._connect() as conn:
+            conn.execute("DELETE FROM parts")
+            conn.execute("DELETE FROM results")
+            conn.executemany("INSERT INTO parts (uuid, data) VALUES (?, ?)", rows)
+            conn.execute("DELETE FROM meta")
+            for key, value in (meta or {}).items():
+                if value is not None:
+                    conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                 (key, value))
+        bot.debug("Saved %s parts to %s" % (len(rows), self.path))
+
+    def update(self, parts, removed=None, meta=None):
+        '''update parts in the store (added or changed, a lookup by uuid),
+           remove parts by uuid, and update metadata.
+        '''
+        rows = [(uuid, self._compress(part)) for uuid, part in parts.items()]
+        with self._connect() as conn:
+            conn.execute("DELETE FROM results")
+            conn.executemany("INSERT OR REPLACE INTO parts (uuid, data) VALUES (?, ?)", rows)
+            conn.executemany("DELETE FROM parts WHERE uuid = ?",
+                             [(uuid,) for uuid in removed or []])
+            for key, value in (meta or {}).items():
+                if value is not None:
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 (key, value))
+        bot.debug("Updated %s parts in %s" % (len(rows), self.path))
+
+    def set_meta(self, meta):
+        '''update metadata (e.g., validators) without changing the parts.
+        '''
+        with self._connect() as conn:
+            for key, value in meta.items():
+                if value is not None:
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 (key, value))
+
+    def get_meta(self, key):
+        '''return a metadata value from the store, or None if not defined.
+        '''
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?",
+                               (key,)).fetchone()
+        if row:
+            return row[0]
+
+    def get_blob(self, key, fingerprint):
+        '''return data saved for the parts (e.g., a search index), or None
+           if it wasn't saved for the same parts (fingerprint).
+        '''
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM blobs WHERE key = ? AND fingerprint = ?",
+                               (key, fingerprint)).fetchone()
+        if row:
+            return row[0]
+
+    def save_blob(self, key, fingerprint, data):
+        '''save data derived from the parts (e.g., a search index), along
+           with the fingerprint of the parts it was derived from.
+        '''
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO blobs (key, fingerprint, data) "
+                         "VALUES (?, ?, ?)", (key, fingerprint, sqlite3.Binary(data)))
+
+    def get_results(self, fingerprint, keys):
+        '''return a lookup of key -> result for the results derived from the
+           parts (e.g., the parts found in a sequence) that were saved for
+           the same parts (fingerprint), missing keys are not included.
+        '''
+        keys = list(keys)
+        results = {}
+        with self._connect() as conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                query = ("SELECT key, data FROM results WHERE fingerprint = ? AND key IN (%s)"
+                         % ",".join("?" * len(chunk)))
+                for key, data in conn.execute(query, [fingerprint] + chunk):
+                    results[key] = json.loads(zlib.decompress(data).decode('utf-8'))
+        return results
+
+    def save_results(self, fingerprint, results):
+        '''save results derived from the parts, a lookup of key -> result
+           (json serializable), along with the fingerprint of the parts.
+        '''
+        rows = [(key, fingerprint, self._compress(result)) for key, result in results.items()]
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO results (key, fingerprint, data) "
+                             "VALUES (?, ?, ?)", rows)
+
+    def _compress(self, part):
+        return zlib.compress(json.dumps(part, default=record_default).encode('utf-8'))
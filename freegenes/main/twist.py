@@ -9,15 +9,25 @@ with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 '''
 
 from freegenes.version import __version__
-from freegenes.utils import str2csv
+from freegenes.utils import iter_csv, write_csv
 from freegenes.logger import bot
-import requests
+from .platemaps import PlatemapCache
+from .credentials import CredentialCache, get_credentials_key, get_token_expiry
+from .pagination import page_urls
+from .session import Session
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urljoin, urlparse, parse_qs, urlencode, urlunparse
 import os
+import threading
 
 class Client(object):
 
     def __init__(self, email=None, token=None, eutoken=None, 
-                       base="https://twist-api.twistbioscience-staging.com/", version="v1"):
+                       base="https://twist-api.twistbioscience-staging.com/", version="v1",
+                       pool_size=None, retries=3, keep_alive=True, rate=None, workers=8,
+                       cache_dir=None, cache_size=256 * 1024 * 1024, credentials=None,
+                       credentials_ttl=3600, lazy=False):
         '''Generate a client for interacting with Twist.  I was unable to generate
            tokens using the API (it doesn't work), and the head of Twist (Gil Raytan) 
            had to manually send them.
@@ -30,13 +40,36 @@ class Client(object):
            ==========
            token: the general api token
            eutoken: the end user token
+           pool_size: the number of connections to keep open to the server
+                      (default is workers, at least 10)
+           retries: the number of retries for failed connections and for
+                    throttled (429) or unavailable (5xx) responses
+           keep_alive: keep connections open between requests (default True)
+           rate: the maximum number of requests per second (default no limit)
+           workers: the number of concurrent requests for functions that
+                    make many requests (e.g., order_platemaps)
+           cache_dir: a directory to cache plate maps (or FREEGENES_CACHE)
+           cache_size: the maximum size (bytes) of cached plate maps
+           credentials: a file to cache tokens and validation between clients
+                        (or FREEGENES_TWIST_CREDENTIALS), by default
+                        twist-credentials.json in the cache_dir, if set
+           credentials_ttl: the time (seconds) to keep cached credentials
+           lazy: if True, validate the token on the first request instead
         '''
         self.version = version
+        self.workers = workers
+        self.session = Session(pool_size=pool_size or max(workers, 10), retries=retries, 
+                               keep_alive=keep_alive, rate=rate)
         self._set_base(base)
+        self._set_cache(cache_dir, cache_size)
+        self._set_credentials(credentials, credentials_ttl)
         self._set_tokens(token, eutoken)
         self._set_headers()
-        self._test_token()
         self._set_email(email)
+        self._validated = False
+        self._validate_lock = threading.Lock()
+        if not lazy:
+            self._validate()
 
     def __repr__(self):
         return self.__str__()
@@ -61,11 +94,20 @@ class Client(object):
             if not username or not password:
                 bot.exit("You must export FREEGENES_TWIST_TOKEN or FREEGENES_TWIST_LOGIN and FREEGENES_TWIST_PASSWORD")
 
+            # A token from a previous login can be reused until it expires
+            key = get_credentials_key("login", self.base, username)
+            cached = self.credentials.get(key) if self.credentials else None
+            if cached:
+                self.token = cached['token']
+                return
+
             headers = {"username": username, "password": password}
-            response = requests.post(self.base + '/api-token-auth/', headers=headers)
+            response = self.session.post(self.base + '/api-token-auth/', headers=headers)
             if response.status_code != 201:
                 bot.exit("Error with authentication, %s:%s" %(response.reason, response.status_code))
             self.token = response.json()['token']
+            if self.credentials:
+                self.credentials.set(key, get_token_expiry(self.token), token=self.token)
 
 
     def _set_base(self, base):
@@ -76,6 +118,28 @@ class Client(object):
             self.base = self.base.strip('/')
 
 
+    def _set_cache(self, cache_dir, cache_size):
+        '''look for FREEGENES_CACHE defined in environ, a directory to cache
+           plate maps (not used if unset).
+        '''
+        self.cache_dir = os.environ.get('FREEGENES_CACHE', cache_dir)
+        self.platemaps = None
+        if self.cache_dir:
+            self.platemaps = PlatemapCache(self.cache_dir, cache_size)
+
+
+    def _set_credentials(self, credentials, ttl):
+        '''look for FREEGENES_TWIST_CREDENTIALS defined in environ, a file to
+           cache credentials, defaulting to a file in the cache directory.
+        '''
+        path = os.environ.get('FREEGENES_TWIST_CREDENTIALS', credentials)
+        if not path and self.cache_dir:
+            path = os.path.join(self.cache_dir, "twist-credentials.json")
+        self.credentials = None
+        if path:
+            self.credentials = CredentialCache(path, ttl)
+
+
     def _get_email(self, email):
         '''get an email (required) either provided by calling function or
            already set in client. Exit if not defined.
@@ -85,6 +149,11 @@ class Client(object):
            email: the email address associated with Twist
         '''
         email = email or self.email
+
+        # A lazy client looks up the email (whoami) when it's validated
+        if not email:
+            self._check_validated()
+            email = self.email
         if not email:
             bot.exit("Email must provided to client, calling function, or in environment FREEGENES_TWIST_EMAIL.")
         return email
@@ -94,9 +163,7 @@ class Client(object):
         '''look for FREEGENES_TWIST_EMAIL defined in environ
         '''
         self.email = os.environ.get('FREEGENES_TWIST_EMAIL', email)
-        if not email:
-            self.whoami()
-        
+
 
     def _set_headers(self):
         '''set the headers to the default, meaning we provide an
@@ -113,10 +180,50 @@ class Client(object):
         '''test that the token works - this function also ensures
            that the base is correct.
         '''
-        if requests.head("%s" % self.base, headers=self.headers).status_code not in [200, 302]:
+        if self.session.head("%s" % self.base, headers=self.headers).status_code not in [200, 302]:
             bot.exit('Provided token is invalid.')
 
 
+    def _get_validation_key(self):
+        return get_credentials_key("validated", self.base, self.token, self.eutoken)
+
+
+    def _validate(self):
+        '''validate the token (and base), and look up the email with whoami
+           if it isn't set. A validation (and the whoami result) is cached
+           in the credentials file (if there is one), so another client with
+           the same base and tokens can skip both requests.
+        '''
+        with self._validate_lock:
+            if self._validated:
+                return
+
+            key = self._get_validation_key()
+            cached = self.credentials.get(key) if self.credentials else None
+            if cached and cached.get('base') == self.base:
+                whoami = cached.get('whoami')
+            else:
+                self._test_token()
+                whoami = None
+
+            if not self.email and whoami is None:
+                whoami = self._get_page("%s/whoami/" % self.base, self.headers)
+            if not self.email and "email" in whoami:
+                self.email = whoami["email"]
+
+            if self.credentials and not cached:
+                self.credentials.set(key, get_token_expiry(self.token),
+                                     base=self.base, whoami=whoami)
+            self._validated = True
+
+
+    def _check_validated(self):
+        '''validate the client before the first request (if it's lazy)
+        '''
+        if not self._validated:
+            self._validate()
+
+
     # Specific API calls
 
     def get(self, url, headers=None, page=None, paginate=True):
@@ -130,30 +237,133 @@ class Client(object):
            page: obtain a specific page of the result.
            paginate: obtain all pages after query (default is True)
         '''
+        self._check_validated()
         heads = headers or self.headers
         fullurl = "%s%s" %(self.base, url)
 
         # If we are provided a page
         if page:
-            fullurl = "%s?page=%s" %(fullurl, page)
-        response = requests.get(fullurl, headers=heads)
+            fullurl = self._get_page_url(fullurl, page)
+        results = self._get_page(fullurl, heads)
 
-        # Return a successful response
-        if response.status_code == 200:
- 
-            results = response.json()
+        # Listings will have results, single entity not
+        if isinstance(results, dict) and "results" in results:
+            if paginate:
+                return [result for page in self._iter_pages(fullurl, results, heads)
+                        for result in page]
+            results = results['results']
+        return results
 
-            # Listings will have results, single entity not
-            if "results" in results:
-                results = results['results']
 
-            # Are there pages?
-            if paginate:
-                while response.next:
-                    results = results + self.get(url, headers, page=response.next)
-            return results
+    def iter_pages(self, url, headers=None):
+        '''yield the results of a listing one page at a time, so a large
+           listing can be processed without holding it in memory. The next
+           pages are retrieved in the background (see _iter_pages).
+
+           Parameters
+           ==========
+           url: the url endpoint to query (without the http/s or domain)
+           headers: if defined, don't use default headers.
+        '''
+        self._check_validated()
+        heads = headers or self.headers
+        fullurl = "%s%s" %(self.base, url)
+        first = self._get_page(fullurl, heads)
+
+        # A single entity (or an unpaginated list) is one page
+        if not isinstance(first, dict) or "results" not in first:
+            yield first if isinstance(first, list) else [first]
+            return
+
+        for page in self._iter_pages(fullurl, first, heads):
+            yield page
+
+
+    def iter_get(self, url, headers=None):
+        '''yield the results of a listing one at a time (see iter_pages).
+        '''
+        for page in self.iter_pages(url, headers):
+            for result in page:
+                yield result
+
+
+    def _iter_pages(self, url, first, headers):
+        '''given the url and parsed response of the first page of a listing,
+           yield the results of each page in order. The next page is given by
+           the page metadata (next, a url or a page number). If the response
+           has a count, the urls of all pages are known, and up to
+           self.workers pages are retrieved at once, otherwise we follow the
+           next pages, retrieving one ahead.
+        '''
+        yield first.get('results', [])
+        next_url = self._get_next_url(url, first)
+        if not next_url:
+            return
+
+        urls = None
+        if first.get('count') is not None:
+            urls = page_urls(next_url, first['count'], len(first.get('results', [])))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+
+            # Known pages, retrieve a window of pages ahead (in order)
+            if urls:
+                futures = deque()
+                for page_url in urls:
+                    futures.append(executor.submit(self._get_page, page_url, headers))
+                    if len(futures) >= self.workers:
+                        yield futures.popleft().result().get('results', [])
+                while futures:
+                    yield futures.popleft().result().get('results', [])
+                return
+
+            future = executor.submit(self._get_page, next_url, headers)
+            while future is not None:
+                page = future.result()
+                future = None
+                next_url = self._get_next_url(next_url, page)
+                if next_url:
+                    future = executor.submit(self._get_page, next_url, headers)
+                yield page.get('results', [])
+
+
+    def _get_page(self, url, headers):
+        '''retrieve a single page (a complete url), and exit on error, since
+           the results would otherwise be incomplete.
+        '''
+        response = self.session.get(url, headers=headers)
+
+        # A cached validation (or token) is no longer valid
+        if response.status_code == 401 and self.credentials:
+            self.credentials.clear(self._get_validation_key())
+            self.credentials.clear(get_credentials_key(
+                "login", self.base, os.environ.get('FREEGENES_TWIST_LOGIN')))
+
+        if response.status_code != 200:
+            bot.exit("Error with %s, return value %s: %s" %(url, response.status_code, response.reason))
+        return response.json()
+
+
+    def _get_next_url(self, url, page):
+        '''return the url for the page after a page of results (retrieved
+           from url), or None if it's the last. The next page can be a
+           url (complete or partial) or a page number.
+        '''
+        next_page = page.get('next') if isinstance(page, dict) else None
+        if next_page in [None, ""]:
+            return None
+        if isinstance(next_page, int) or str(next_page).isdigit():
+            return self._get_page_url(url, next_page)
+        return urljoin(self.base, next_page)
 
-        bot.exit("Error with %s, return value %s: %s" %(url, response.status_code, response.reason))
+
+    def _get_page_url(self, url, page):
+        '''return a url with the page parameter set to a page number.
+        '''
+        parsed = urlparse(url)
+        params = parse_qs(parsed.query)
+        params['page'] = [page]
+        return urlunparse(parsed._replace(query=urlencode(params, doseq=True)))
 
 
     # Endpoints
@@ -224,11 +434,17 @@ class Client(object):
     # Catalog Items
 
     def catalog_items(self):
-        '''Look up account prices based on account id.
+        '''Look up catalog items.
         '''
         return self.get('/v1/catalog-items')
 
 
+    def iter_catalog_items(self):
+        '''Yield catalog items one at a time, as pages are retrieved.
+        '''
+        return self.iter_get('/v1/catalog-items')
+
+
     def user(self, email=None):
         '''Look up user by email.
         '''
@@ -250,6 +466,14 @@ class Client(object):
         return self.get('/v1/users/%s/orders/' % email)
 
 
+    def iter_orders(self, email=None):
+        '''Yield orders for a user (based on email) one at a time, as
+           pages are retrieved.
+        '''
+        email = self._get_email(email)
+        return self.iter_get('/v1/users/%s/orders/' % email)
+
+
     # Orders
 
     def order_items(self, sfdc_id, email=None):
@@ -259,7 +483,8 @@ class Client(object):
         email = self._get_email(email)
         return self.get('/v1/users/%s/orders/%s/items' % (email, sfdc_id))
 
-    def order_platemaps_by_barcode(self, sfdc_id, barcode, email=None, return_download=False):
+    def order_platemaps_by_barcode(self, sfdc_id, barcode, email=None, return_download=False,
+                                         output=None):
         '''Look up order plate maps for a user based on email.
            sfdc_id and barcode.
 
@@ -269,44 +494,147 @@ class Client(object):
            barcode: the barcode for the shipment
            email: an email to override the default
            return_download: if True, return the entire response with path to download
+           output: if defined, also write the plate map (csv) to this file
         '''
+        # A plate map doesn't change, so the cache is checked first
+        if not return_download:
+            rows = self._get_cached_platemap(sfdc_id, barcode, output)
+            if rows is not None:
+                return list(rows)
+
         email = self._get_email(email)
         result = self.get('/v1/users/%s/orders/%s/plate-maps/%s' % (email, sfdc_id, barcode))
 
         # The result returns an amazon file path
         if "platemaps_file_url" in result and not return_download:
-            result = requests.get(result["platemaps_file_url"])
-            if result.status_code == 200:
+            response = self.session.get(result["platemaps_file_url"], stream=True)
+            if response.status_code != 200:
+                return response
 
-                # Return list of rows, first is header row
-                result = str2csv(result.text)
+            # Return list of rows, first is header row
+            with response:
+                result = list(self._iter_platemap(response, sfdc_id, barcode, output))
         return result
 
 
-    def order_platemaps(self, sfdc_id, email=None):
+    def iter_order_platemaps_by_barcode(self, sfdc_id, barcode, email=None, output=None):
+        '''Like order_platemaps_by_barcode, but yield the rows (the first is
+           the header row) as the plate map is downloaded, so a large plate
+           map is processed in bounded memory.
+
+           Parameters
+           ==========
+           sfdc_id: should be the order id.
+           barcode: the barcode for the shipment
+           email: an email to override the default
+           output: if defined, also write the plate map (csv) to this file
+        '''
+        rows = self._get_cached_platemap(sfdc_id, barcode, output)
+        if rows is not None:
+            for row in rows:
+                yield row
+            return
+
+        email = self._get_email(email)
+        result = self.get('/v1/users/%s/orders/%s/plate-maps/%s' % (email, sfdc_id, barcode))
+        if "platemaps_file_url" not in result:
+            bot.exit("Plate map for %s %s does not have a file url." % (sfdc_id, barcode))
+
+        response = self.session.get(result["platemaps_file_url"], stream=True)
+        if response.status_code != 200:
+            bot.exit("Error downloading plate map for %s, return value %s: %s" %(barcode,
+                                                                                response.status_code,
+                                                                                response.reason))
+        with response:
+            for row in self._iter_platemap(response, sfdc_id, barcode, output):
+                yield row
+
+
+    def _iter_platemap(self, response, sfdc_id, barcode, output=None):
+        '''yield the rows of a streamed plate map (csv) response, read in
+           chunks (lines) instead of loading the whole file, and add them
+           to the plate map cache (if there is one) as they are read.
+        '''
+        response.encoding = response.encoding or "utf-8"
+        lines = response.iter_lines(decode_unicode=True)
+        rows = iter_csv(lines, output=output)
+        if self.platemaps is not None:
+            rows = self.platemaps.save(self.base, sfdc_id, barcode, rows)
+        return rows
+
+
+    def _get_cached_platemap(self, sfdc_id, barcode, output=None):
+        '''return an iterator over the rows of a cached plate map (written
+           to output as csv if defined), or None if it's not cached.
+        '''
+        if self.platemaps is None:
+            return None
+        path = self.platemaps.get(self.base, sfdc_id, barcode)
+        if path is None:
+            return None
+
+        bot.debug("Using cached plate map for %s %s" % (sfdc_id, barcode))
+        rows = self.platemaps.iter_rows(path)
+        if output:
+            rows = write_csv(rows, output)
+        return rows
+
+
+    def order_platemaps(self, sfdc_id, email=None, workers=None, refresh=False):
         '''A wrapper for order_platemaps_by_barcode, will handle parsing over
            all shipment barcodes from containers for a single order. The
-           entire function is a bit slow with the staging API.
+           plate maps for the containers are retrieved concurrently, and the
+           rows are merged in the order of the shipments and containers
+           (with the header row from the first). If any plate map can't be
+           retrieved, we exit instead of returning an incomplete plate map.
+
+           With a plate map cache, the barcodes of an order are saved once
+           all of its shipments are received, so a cached order doesn't
+           need any requests. Use refresh if shipments can still be added
+           to a received order.
 
            Parameters
            ==========
            sfdc_id: should be the order id.
            email: an email to override the default
+           workers: the number of concurrent requests (default self.workers)
+           refresh: retrieve the order items even if the barcodes are cached
         '''
-        email = self._get_email(email)
-        items = self.order_items(sfdc_id)
-        rows = []
+        barcodes = None
+        if self.platemaps is not None and not refresh:
+            barcodes = self.platemaps.get_barcodes(self.base, sfdc_id)
 
-        for shipment in items["shipments"]: # typically < 5
-            for container in shipment['containers']:
-                new_rows = self.order_platemaps_by_barcode(
-                               sfdc_id=sfdc_id, 
-                               barcode=container["barcode"])
-                if not rows:
-                    rows = new_rows
-                else:
-                    rows = rows + new_rows[1:]
-        return rows                 
+        if barcodes is None:
+            email = self._get_email(email)
+            items = self.order_items(sfdc_id, email=email)
+            barcodes = [container["barcode"] for shipment in items["shipments"]
+                        for container in shipment['containers']]
+
+            received = [shipment.get('status') == 'received' for shipment in items["shipments"]]
+            if self.platemaps is not None and received and all(received):
+                self.platemaps.save_barcodes(self.base, sfdc_id, barcodes)
+
+        def get_platemap(barcode):
+            return self.order_platemaps_by_barcode(sfdc_id=sfdc_id,
+                                                   barcode=barcode,
+                                                   email=email)
+
+        rows = []
+        failed = []
+        workers = workers or self.workers
+        self.session.reserve(workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for barcode, new_rows in zip(barcodes, executor.map(get_platemap, barcodes)):
+                if not isinstance(new_rows, list):
+                    failed.append("%s (%s: %s)" %(barcode, getattr(new_rows, "status_code", None),
+                                                           getattr(new_rows, "reason", None)))
+                    continue
+                rows.extend(new_rows[1:] if rows else new_rows)
+
+        # A plate map without some containers would be silently incomplete
+        if failed:
+            bot.exit("Cannot retrieve plate maps for order %s: %s" %(sfdc_id, ", ".join(failed)))
+        return rows
 
 
     def order_platemaps_by_shipment(self, sfdc_id, shipment_id, email=None):
@@ -0,0 +1,923 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+import asyncio
+import datetime
+import email.utils
+import os
+import stat
+import time
+import zlib
+
+import pytest
+import requests
+
+from freegenes.logger import bot
+from freegenes.main import Client
+from freegenes.main.asynchronous import AsyncClient
+from freegenes.main.credentials import CredentialCache, get_token_expiry
+from freegenes.main.cache import get_newest
+from freegenes.main.helpers import select_parts
+from freegenes.main.kmers import KmerIndex, minimizers
+from freegenes.main.mirror import Mirror
+from freegenes.main.pagination import page_urls
+from freegenes.main.platemaps import PlatemapCache
+from freegenes.main.records import Part, Record, to_records
+from freegenes.main.responses import ResponseCache
+from freegenes.main import session as session_module
+from freegenes.main.twist import Client as TwistClient
+from freegenes.utils import (
+    Automaton,
+    encode,
+    PackedQuery,
+    PackedSequence,
+    iter_csv,
+    reverse_complement
+)
+
+
+def _client(parts):
+    '''return a client that will not contact the server, with a parts
+       cache already populated from a lookup of uuid -> sequence.
+    '''
+    client = Client(token="test", validate=False)
+    client.cache['parts'] = {uuid: {"uuid": uuid, "optimized_sequence": seq}
+                             for uuid, seq in parts.items()}
+    return client
+
+
+def test_automaton():
+
+    automaton = Automaton()
+    automaton.add("he", 1)
+    automaton.add("she", 2)
+    automaton.add("hers", 3)
+    automaton.add("his", 4)
+    matches = sorted(automaton.search("ushers"))
+    assert matches == [(1, 4, 2), (2, 4, 1), (2, 6, 3)]
+
+
+def test_iter_csv(tmp_path):
+
+    output = str(tmp_path / "platemap.csv")
+    rows = iter_csv(iter(["Plate,Well", "", "P1,A1"]), output=output)
+    assert next(rows) == ["Plate", "Well"]
+    assert list(rows) == [["P1", "A1"]]
+    assert open(output).read() == "Plate,Well\n\nP1,A1\n"
+
+
+def test_packed_sequence():
+
+    packed = PackedSequence("ATGGCTA")
+    assert len(packed) == 7
+    assert str(packed) == "ATGGCTA"
+    assert str(packed.reverse_complement()) == "TAGCCAT"
+    assert reverse_complement("ATGGCTAN") == "NTAGCCAT"
+
+    # Mismatches are counted on the packed data (N is always a mismatch)
+    query = PackedQuery(encode("GGATGGCTANCATGGGTA"))
+    assert query.count_mismatches(packed, 2) == 0
+    assert query.count_mismatches(packed, 11) == 1
+    assert query.count_mismatches(packed, 3) == sum(
+        a != b for a, b in zip("ATGGCTA", "TGGCTAN"))
+
+
+def test_derive_parts():
+
+    client = _client({"one": "ATGAAACCC", "two": "GGGTTTTTT", "three": "AAA"})
+    sequence = "CC" + "ATGAAACCC" + "AAAAAACCC"
+    selected = client._derive_parts(sequence, circular=False)
+    assert selected == [("one", ">", 2, 11), ("two", "<", 11, 20)]
+
+    # The index is only rebuilt when the parts change, results are memoized
+    index = client._parts_index
+    assert len(index.memo) == 1
+    assert client._derive_parts(sequence, circular=False) == selected
+    assert client._parts_index is index and len(index.memo) == 1
+
+    # The automaton is built on the first search, not with the index
+    client.cache['parts'] = dict(client.cache['parts'])
+    assert client._get_parts_index().automaton is None
+    client._derive_parts(sequence, circular=False)
+    assert client._parts_index is not index
+    assert client._parts_index.automaton is not None
+
+    # A circular sequence finds parts across the origin once
+    sequence = "AACCC" + "GGGGGGGG" + "ATGA"
+    selected = client._derive_parts(sequence)
+    assert selected == [("one", ">", 13, 22)]
+    assert client._derive_parts(sequence, circular=False) == []
+
+    # A batch (with a process pool) gives the same result for each sequence,
+    # searched by the pool with a new client (without memoized results)
+    client = _client({"one": "ATGAAACCC", "two": "GGGTTTTTT", "three": "AAA"})
+    sequences = [sequence, "CC" + "ATGAAACCC" + "AAAAAACCC", "GGGG"]
+    assert client.derive_parts_batch(sequences, workers=2) == \
+        [[("one", ">", 13, 22)], [("one", ">", 2, 11), ("two", "<", 11, 20)], []]
+    assert len(client._parts_index.memo) == 3
+
+
+def test_refresh_parts_cache():
+
+    client = _client({"one": "ATGAAACCC", "two": "GGGTTTTTT"})
+    for part in client.cache['parts'].values():
+        part['time_updated'] = "2019-10-01T00:00:00Z"
+    assert client._derive_parts("ATGAAACCCTTTT", circular=False) == [("one", ">", 0, 9)]
+    index = client._parts_index
+
+    # The server lists parts newest first, one new and one changed
+    changed = [{"uuid": "four", "optimized_sequence": "CCCTTTT",
+                "time_updated": "2019-10-03T00:00:00Z"},
+               {"uuid": "one", "optimized_sequence": "ATGAAAGGG",
+                "time_updated": "2019-10-02T00:00:00Z"},
+               dict(client.cache['parts']['two'])]
+    client._get_page = lambda url, headers: {"count": 3, "next": None, "results": changed}
+
+    client.refresh_parts_cache()
+    assert sorted(client.cache['parts']) == ["four", "one", "two"]
+    assert client._derive_parts("ATGAAACCCTTTT", circular=False) == [("four", ">", 6, 13)]
+    assert client._parts_index is index
+
+
+def test_modified_times(tmp_path):
+
+    client = Client(token="test", validate=False)
+
+    # 01:30-05:00 (06:30 UTC) is after 01:00-06:00 (07:00 UTC) as a string
+    assert get_newest(["2019-11-03T01:30:00-05:00", "2019-11-03T01:00:00-06:00"]) == \
+        "2019-11-03T01:00:00-06:00"
+    assert get_newest(["2019-11-03T01:00:00Z", None]) is None
+
+    page = {"count": 3, "next": None, "results": [
+        {"uuid": "new", "time_updated": "2019-11-03T01:10:00-06:00"},
+        {"uuid": "changed", "time_updated": "2019-11-03T01:50:00-05:00"},
+        {"uuid": "old", "time_updated": "2019-11-03T01:00:00-05:00"}]}
+    client._get_page = lambda url, headers: page
+    records, count = client._get_modified('parts', "2019-11-03T01:20:00-05:00")
+    assert [record['uuid'] for record in records] == ["new", "changed"] and count == 3
+
+    # A page that isn't newest first can't be trusted to stop
+    page['results'].reverse()
+    assert client._get_modified('parts', "2019-11-03T01:20:00-05:00") == ([], None)
+
+    snapshot = Mirror(str(tmp_path / "mirror.db"))
+    snapshot.save("parts", page['results'])
+    assert snapshot.get_watermark("parts") == "2019-11-03T01:10:00-06:00"
+
+
+def test_page_urls():
+
+    urls = page_urls("https://freegenes.dev/api/parts/?limit=2&offset=2", 7, 2)
+    assert [url.split("offset=")[-1] for url in urls] == ["2", "4", "6"]
+
+    urls = page_urls("https://freegenes.dev/api/parts/?page=2", 7, 3)
+    assert [url.split("page=")[-1] for url in urls] == ["2", "3"]
+    assert page_urls("https://freegenes.dev/api/parts/?cursor=xyz", 7, 3) is None
+
+
+def test_select_parts():
+
+    coords = [("a", ">", 0, 10), ("b", ">", 5, 20), ("c", ">", 20, 25),
+              ("d", ">", 12, 19), ("e", "<", 0, 30)]
+    assert select_parts(coords) == [[("e", "<", 0, 30)]]
+
+    tilings = select_parts(coords, top=3)
+    assert tilings[1] == [("a", ">", 0, 10), ("d", ">", 12, 19), ("c", ">", 20, 25)]
+    assert tilings[2] == [("b", ">", 5, 20), ("c", ">", 20, 25)]
+
+    # In a circular sequence of length 30, one part can wrap the origin
+    coords = [("a", ">", 8, 20), ("b", ">", 22, 38), ("c", ">", 25, 32)]
+    assert select_parts(coords, length=30) == [[("a", ">", 8, 20), ("b", ">", 22, 38)]]
+    assert select_parts(coords, top=2, length=30)[1] == [("a", ">", 8, 20), ("c", ">", 25, 32)]
+
+
+def test_records():
+
+    data = {"uuid": "one", "name": "Thread", "genbank": {"features": []},
+            "optimized_sequence": "ATG", "new_field": 1}
+    part = Part(data)
+    assert part.uuid == "one" and part.genbank == {"features": []}
+    assert part['genbank'] == {"features": []} and part.get('new_field') == 1
+    assert part.get('full_sequence') is None and "full_sequence" not in part
+    assert part == data and dict(part) == data
+
+    part['name'] = "Twine"
+    assert part.name == "Twine"
+
+
+def test_resolve_records():
+
+    entities = {"plates": {"plate": {"uuid": "plate", "wells": ["one", "two"]},
+                           "other": {"uuid": "other", "wells": ["three"]}},
+                "wells": {"one": {"uuid": "one", "samples": ["a"]},
+                          "two": {"uuid": "two", "samples": ["b"]},
+                          "three": {"uuid": "three", "samples": ["c"]}},
+                "samples": {"a": {"uuid": "a", "part": "x"},
+                            "b": {"uuid": "b", "part": "y"},
+                            "c": {"uuid": "c", "part": "z"}}}
+    urls = []
+
+    def get_entity(name, uuid=None):
+        urls.append((name, uuid))
+        if uuid is None:
+            return client.loader.bind(to_records(list(entities[name].values()), name))
+        return client.loader.bind(to_records(entities[name][uuid], name))
+
+    client = Client(token="test", validate=False, records=True)
+    client.get_entity = get_entity
+    plate = client.get_entity("plates", "plate")
+    wells = plate.resolve('wells')
+    assert [well.uuid for well in wells] == ["one", "two"]
+    assert plate.resolve('wells')[0] is wells[0]
+    assert sorted(urls) == [("plates", "plate"), ("wells", "one"), ("wells", "two")]
+
+    # The records bound together are a batch, and resolving a relation
+    # loads the references of the batch, not every reference seen
+    client.loader.clear()
+    del urls[:]
+    plates = client.get_entity("plates")
+    assert [well.uuid for well in plates[0].resolve('wells')] == ["one", "two"]
+    assert sorted(urls) == [("plates", None), ("wells", "one"), ("wells", "three"),
+                            ("wells", "two")]
+    samples = plates[1].resolve('wells')[0].resolve('samples')
+    assert [sample.uuid for sample in samples] == ["c"]
+    assert sorted(urls[-3:]) == [("samples", "a"), ("samples", "b"), ("samples", "c")]
+
+    # A listing that isn't walked (another batch) isn't loaded
+    client.loader.bind(to_records([{"uuid": "d", "part": "w"}], "samples"))
+    entities["parts"] = {uuid: {"uuid": uuid} for uuid in "xyz"}
+    assert samples[0].resolve('part').uuid == "z"
+    assert sorted(urls[-3:]) == [("parts", "x"), ("parts", "y"), ("parts", "z")]
+    assert ("parts", "w") not in urls
+
+    # The identity map keeps the records used most recently
+    client.loader.max_size = 2
+    client.loader.bind(to_records(list(entities["wells"].values()), "wells"))
+    assert len(client.loader.records) == 2
+
+
+def test_response_cache():
+
+    cache = ResponseCache(ttls={"plates": 0})
+    cache.set(("https://freegenes.dev/api/tags/?limit=1000", True), "tags", [{"tag": "a"}])
+    cache.set(("https://freegenes.dev/api/plates/?limit=1000", True), "plates", [])
+
+    response = cache.get(("https://freegenes.dev/api/tags/?limit=1000", True))
+    response.append({"tag": "b"})
+    assert cache.get(("https://freegenes.dev/api/tags/?limit=1000", True)) == [{"tag": "a"}]
+    assert cache.get(("https://freegenes.dev/api/plates/?limit=1000", True)) is None
+    assert cache.stats() == {"hits": 2, "misses": 1, "size": 1}
+
+    cache.invalidate("tags")
+    assert len(cache) == 0
+
+
+def test_platemap_cache(tmp_path):
+
+    cache = PlatemapCache(str(tmp_path))
+    rows = [["Plate", "Well"], ["P1", "A1"]]
+    assert cache.get("base", "order", "barcode") is None
+
+    # Rows are only cached if all are read
+    saved = cache.save("base", "order", "barcode", iter(rows))
+    next(saved)
+    saved.close()
+    assert cache.get("base", "order", "barcode") is None
+
+    assert list(cache.save("base", "order", "barcode", iter(rows))) == rows
+    path = cache.get("base", "order", "barcode")
+    assert list(cache.iter_rows(path)) == rows
+
+    cache.max_size = 0
+    cache.evict()
+    assert cache.get("base", "order", "barcode") is None
+
+    assert cache.get_barcodes("base", "order") is None
+    cache.save_barcodes("base", "order", ["one", "two"])
+    assert cache.get_barcodes("base", "order") == ["one", "two"]
+
+
+def test_order_platemaps():
+
+    client = TwistClient.__new__(TwistClient)
+    client.base, client.workers, client.platemaps = "https://twist", 2, None
+    client.session = session_module.Session()
+    client._get_email = lambda email: "user@example.com"
+    client.order_items = lambda sfdc_id, email=None: {"shipments": [
+        {"status": "received", "containers": [{"barcode": "one"}, {"barcode": "two"}]}]}
+
+    platemaps = {"one": [["Plate", "Well"], ["P1", "A1"]],
+                 "two": [["Plate", "Well"], ["P2", "B1"]]}
+    client.order_platemaps_by_barcode = lambda sfdc_id, barcode, email=None: platemaps[barcode]
+    assert client.order_platemaps("order") == [["Plate", "Well"], ["P1", "A1"], ["P2", "B1"]]
+
+    # A failed download doesn't return an incomplete plate map
+    platemaps["two"] = _Response(500)
+    with pytest.raises(SystemExit):
+        client.order_platemaps("order")
+
+
+def test_twist_pages():
+
+    class Response(object):
+        status_code = 200
+
+        def __init__(self, body):
+            self.body = body
+
+        def json(self):
+            return self.body
+
+    def get(url, headers=None):
+        number = int(url.split("page=")[1]) if "page=" in url else 1
+        body = {"results": list(range(number * 10 - 10, min(number * 10, 25)))}
+        if number < 3:
+            body["next"] = number + 1
+        return Response(body)
+
+    client = TwistClient.__new__(TwistClient)
+    client.base, client.headers, client.workers = "https://twist", {}, 2
+    client._validated = True
+    client.session = type("Session", (object,), {"get": staticmethod(get)})()
+
+    assert client.get('/v1/catalog-items') == list(range(25))
+    assert [len(page) for page in client.iter_pages('/v1/catalog-items')] == [10, 10, 5]
+    assert client.get('/v1/catalog-items', page=3, paginate=False) == list(range(20, 25))
+
+
+def test_credential_cache(tmp_path):
+
+    path = str(tmp_path / "credentials.json")
+    credentials = CredentialCache(path, ttl=60)
+    credentials.set("key", token="token")
+    credentials.set("expired", time.time() - 1, token="token")
+    assert credentials.get("key")['token'] == "token"
+    assert credentials.get("expired") is None
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    # A file others can read isn't used
+    os.chmod(path, 0o644)
+    assert credentials.get("key") is None
+
+    # eyJleHAiOiAxMH0 is {"exp": 10}
+    assert get_token_expiry("header.eyJleHAiOiAxMH0.signature") == 10
+    assert get_token_expiry("token") is None
+
+
+def test_offline(tmp_path):
+
+    path = str(tmp_path / "mirror.db")
+    Mirror(path).save("parts", [{"uuid": "part", "optimized_sequence": "ATGAAACCCGGGTTT"}])
+
+    client = Client(offline=True, snapshot=path)
+    assert client.get('/api/parts/part')['uuid'] == "part"
+    assert client._derive_parts("GGATGAAACCCGGGTTTCC", circular=False) == [("part", ">", 2, 17)]
+    with pytest.raises(SystemExit):
+        client.get('/api/tags/')
+
+    # A mirror that doesn't exist isn't created
+    missing = str(tmp_path / "missing.db")
+    assert Client(offline=True, snapshot=missing).snapshot is None
+    assert not os.path.exists(missing)
+
+
+class _Server(object):
+    '''a stub for the pages of listings, with records by entity (listed
+       newest first when ordered by time), and the urls requested.
+    '''
+    def __init__(self, records):
+        self.records = records
+        self.urls = []
+
+    def get_page(self, url, headers=None):
+        self.urls.append(url)
+        entity = url.split("/api/")[1].split("/")[0]
+        records = self.records[entity]
+        if "ordering=-time_updated" in url:
+            records = sorted(records, key=lambda x: x["time_updated"], reverse=True)
+        offset = int(url.split("offset=")[1]) if "offset=" in url else 0
+        limit = int(url.split("limit=")[1].split("&")[0])
+        next_url = None
+        if offset + limit < len(records):
+            next_url = "https://freegenes.dev/api/%s/?limit=%s&offset=%s" %(entity, limit,
+                                                                          offset + limit)
+        return {"count": len(records), "next": next_url,
+                "results": [dict(record) for record in records[offset:offset + limit]]}
+
+
+def test_iter_pages():
+
+    server = _Server({"tags": [{"uuid": "tag%s" % i, "tag": "tag%s" % i} for i in range(25)]})
+    client = Client(token="test", validate=False)
+    client._get_page = server.get_page
+
+    for prefetch in [True, False]:
+        del server.urls[:]
+        pages = list(client._iter_pages('/api/tags/', limit=10, prefetch=prefetch))
+        assert [len(page) for page in pages] == [10, 10, 5]
+        assert [tag["uuid"] for tag in client.iter_entity('tags', limit=10, prefetch=prefetch)] == \
+            ["tag%s" % i for i in range(25)]
+
+    # Closing early stops the requests (a prefetched page is already requested)
+    for prefetch, requested in [(True, 2), (False, 1)]:
+        del server.urls[:]
+        pages = client._iter_pages('/api/tags/', limit=10, prefetch=prefetch)
+        assert len(next(pages)) == 10
+        pages.close()
+        assert len(server.urls) == requested
+
+    # Records are bound to the loader, a page at a time
+    client = Client(token="test", validate=False, records=True)
+    client._get_page = server.get_page
+    tags = list(client.iter_tags())
+    assert isinstance(tags[0], Record) and tags[0].uuid == "tag0"
+    assert client.loader.records[("tags", "tag24")] is tags[24]
+
+
+def test_mirror_resync(tmp_path):
+
+    path = str(tmp_path / "mirror.db")
+    server = _Server({"tags": [{"uuid": "tag%s" % i, "tag": "tag%s" % i,
+                                "time_updated": "2019-10-0%sT00:00:00Z" % i} for i in range(1, 4)]})
+    client = Client(token="test", validate=False)
+    client._get_page = server.get_page
+    assert client.mirror(path, entities=["tags"]) == {"tags": 3}
+    snapshot = Mirror(path)
+    assert snapshot.get_watermark("tags") == "2019-10-03T00:00:00Z"
+
+    # Only records modified since the watermark (inclusive) are retrieved
+    server.records["tags"][0].update(tag="changed", time_updated="2019-10-04T00:00:00Z")
+    assert client.mirror(path, entities=["tags"]) == {"tags": 2}
+    assert snapshot.get("tags", "tag1")["tag"] == "changed"
+    assert snapshot.get_watermark("tags") == "2019-10-04T00:00:00Z"
+
+    # A deleted record changes the count, so all records are listed again
+    del server.records["tags"][1]
+    assert client.mirror(path, entities=["tags"]) == {"tags": 2}
+    assert sorted(record["uuid"] for record in snapshot.list("tags")) == ["tag1", "tag3"]
+
+    with pytest.raises(SystemExit):
+        client.mirror(path, entities=["tags\" AS SELECT 1; --"])
+    with pytest.raises(ValueError):
+        snapshot.save("nothing", [])
+
+
+def test_mirror_command(tmp_path, monkeypatch):
+
+    import freegenes.client
+
+    path = str(tmp_path / "mirror.db")
+    server = _Server({"tags": [{"uuid": "tag%s" % i, "time_updated": "2019-10-01T00:00:00Z"}
+                               for i in range(1500)]})
+    monkeypatch.setenv("FREEGENES_TOKEN", "test")
+    monkeypatch.setattr(Client, "_test_token", lambda self: None)
+    monkeypatch.setattr(Client, "_get_page", lambda self, url, headers: server.get_page(url))
+    monkeypatch.setattr("sys.argv", ["freegenes", "mirror", path, "--entity", "tags",
+                                     "--workers", "2"])
+    freegenes.client.main()
+
+    # The listing is saved a page at a time
+    assert len(server.urls) == 2
+    assert Mirror(path).count("tags") == 1500
+    assert Mirror(path).query("SELECT COUNT(*) FROM tags") == [(1500,)]
+
+
+def test_async_client_without_token(monkeypatch):
+
+    monkeypatch.delenv("FREEGENES_TOKEN", raising=False)
+    client = AsyncClient(validate=False)
+    assert client.token is None
+    assert client.headers["Authorization"] == "Token None"
+
+
+def test_async_client(monkeypatch):
+
+    aiohttp = pytest.importorskip("aiohttp")
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    monkeypatch.delenv("FREEGENES_BASE", raising=False)
+    tags = [{"uuid": "tag%s" % i, "tag": "tag%s" % i} for i in range(25)]
+    requests_made = []
+
+    async def head(request):
+        return web.Response()
+
+    async def listing(request):
+        requests_made.append(request.path_qs)
+
+        # The first request is throttled, and retried
+        if len(requests_made) == 2:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query["limit"])
+        next_url = None
+        if offset + limit < len(tags):
+            next_url = str(request.url.with_query(limit=limit, offset=offset + limit))
+        return web.json_response({"count": len(tags), "next": next_url,
+                                  "results": tags[offset:offset + limit]})
+
+    async def write(request):
+        data = await request.post()
+        return web.json_response({"method": request.method, "path": request.path,
+                                  "data": {key: data.getall(key) for key in data}},
+                                 status=201 if request.method == "POST" else 200)
+
+    async def delete(request):
+        return web.Response(status=204)
+
+    app = web.Application()
+    app.router.add_route("HEAD", "/", head)
+    app.router.add_get("/api/tags/", listing)
+    app.router.add_post("/api/{entity}/", write)
+    app.router.add_route("PUT", "/api/{entity}/{uuid}/", write)
+    app.router.add_route("PATCH", "/api/{entity}/{uuid}/", write)
+    app.router.add_delete("/api/{entity}/{uuid}/", delete)
+
+    async def run():
+        async with TestServer(app) as server:
+            base = str(server.make_url("/"))
+            async with AsyncClient(token="test", base=base, backoff=0) as client:
+
+                # All pages (limit/offset) are retrieved, after a retry
+                assert await client.get("/api/tags/", limit=10) == tags
+                assert len(requests_made) == 4
+
+                # Create and update take the arguments of the client, and
+                # lists are sent as repeated fields
+                created = await client.create_plateset("set", "plates", ["one", "two"])
+                assert created == {"method": "POST", "path": "/api/platesets/", "data": {
+                    "name": ["set"], "description": ["plates"], "plates": ["one", "two"]}}
+                updated = await client.update_tag("tag1", "changed")
+                assert (updated["method"], updated["path"]) == ("PUT", "/api/tags/tag1/")
+                assert updated["data"] == {"tag": ["changed"]}
+                parts = _client({"one": "ATGAAACCC"})
+                client._get_parts_client = lambda: parts
+                created = await client.create_composite_part("composite", "CCATGAAACCCGG",
+                                                             circular=False)
+                assert created["data"]["parts"] == ["one"]
+                assert created["data"]["direction_string"] == [">"]
+                patched = await client.patch_tag("tag1", {"tag": "patched"})
+                assert (patched["method"], patched["data"]) == ("PATCH", {"tag": ["patched"]})
+                assert await client.delete_tag("tag1") is True
+
+            # Connection errors are retried, then raised
+            async with AsyncClient(token="test", base=base, validate=False,
+                                   retries=1, backoff=0) as client:
+                await server.close()
+                with pytest.raises(aiohttp.ClientConnectionError):
+                    await client.get("/api/tags/")
+
+    asyncio.run(run())
+
+
+def test_parts_details_records():
+
+    client = Client(token="test", validate=False, records=True)
+    details = {"uuid": "part", "optimized_sequence": "ATGAAACCCGGGTTT"}
+    client._get = lambda url, headers, paginate=True: details
+    parts = client._get_parts_details({"part": Part({"uuid": "part"})})
+    assert isinstance(parts["part"], Part)
+    assert parts["part"].optimized_sequence == "ATGAAACCCGGGTTT"
+
+
+def test_parts_details():
+
+    client = Client(token="test", validate=False)
+    listing = [{"uuid": "one", "optimized_sequence": "ATGAAACCC"},
+               {"uuid": "two", "optimized_sequence": "GGGTTTTTT"}]
+    urls = []
+
+    def get(url, headers=None, paginate=True, limit=1000, cache=True):
+        urls.append(url)
+        if url == '/api/parts/':
+            return [dict(part) for part in listing]
+        uuid = url.split("/")[-2]
+        return {"uuid": uuid, "optimized_sequence": "CCC" + uuid}
+
+    # A listing with complete records doesn't need any detail requests
+    client.get = get
+    parts = client._get_parts_records()
+    assert urls == ['/api/parts/']
+    assert parts == {part["uuid"]: part for part in listing}
+
+    # Only the parts missing a required field are retrieved
+    del urls[:]
+    listing.append({"uuid": "three"})
+    listing.append({"uuid": "four", "optimized_sequence": None})
+    parts = client._get_parts_records()
+    assert urls == ['/api/parts/', '/api/parts/three/']
+    assert parts["three"]["optimized_sequence"] == "CCCthree"
+    assert parts["one"] == listing[0]
+
+    del urls[:]
+    client._get_parts_records(fields=["uuid", "gene_id"])
+    assert sorted(urls) == ['/api/parts/', '/api/parts/four/', '/api/parts/one/',
+                            '/api/parts/three/', '/api/parts/two/']
+
+
+def test_bulk():
+
+    client = Client(token="test", validate=False)
+
+    def create_entity(name, data):
+        if data["name"] == "exit":
+            bot.exit("Cannot create %s" % name)
+        return dict(data, uuid=data["name"])
+
+    client.create_entity = create_entity
+    results = client.create_tags([{"name": "one"}, {"name": "exit"}, {}, {"name": "two"}])
+    assert [result["success"] for result in results] == [True, False, False, True]
+    assert [result["key"] for result in results] == [0, 1, 2, 3]
+    assert results[3]["result"] == {"name": "two", "uuid": "two"}
+
+    # Requests without a uuid aren't made
+    client.update_entity = lambda name, uuid, data: {}
+    results = client.update_tags({"": {"tag": "a"}, "tag": {"tag": "b"}})
+    assert [result["success"] for result in results] == [False, True]
+    assert results[0]["error"] == "A unique id (uuid) is required."
+
+    client.offline = True
+    results = client.create_tags([{"name": "one"}])
+    assert results[0]["error"] == "The client is offline."
+
+
+def test_bulk_composite_parts():
+
+    client = _client({"one": "ATGAAACCC", "two": "GGGTTTTTT"})
+    sequence = "CC" + "ATGAAACCC" + "AAAAAACCC"
+    sent = {}
+    client.create_entity = lambda name, data: sent.setdefault(data["name"], data)
+    client.update_entity = lambda name, uuid, data: sent.setdefault(uuid, data)
+    client.patch_entity = lambda name, uuid, data: sent.setdefault(uuid, data)
+
+    # Parts are derived (like create_composite_part) unless part_ids are given
+    results = client.create_composite_parts([
+        {"name": "derived", "sequence": sequence},
+        {"name": "given", "sequence": sequence, "part_ids": ["two"], "direction_string": ">"}],
+        circular=False)
+    assert [result["success"] for result in results] == [True, True]
+    assert sent["derived"]["parts"] == ["one", "two"] and sent["derived"]["direction_string"] == "><"
+    assert sent["given"]["parts"] == ["two"] and "part_ids" not in sent["given"]
+
+    results = client.update_composite_parts({"u1": {"name": "a", "sequence": sequence}},
+                                            circular=False)
+    assert results[0]["success"] and sent["u1"]["parts"] == ["one", "two"]
+
+    # A patch derives parts for a new sequence, and part_ids require a sequence
+    results = client.patch_composite_parts({"p1": {"sequence": sequence},
+                                            "p2": {"part_ids": ["one"]}}, circular=False)
+    assert [result["success"] for result in results] == [True, False]
+    assert sent["p1"]["part_ids"] == ["one", "two"] and sent["p1"]["direction_string"] == "><"
+    assert results[1]["error"] == "If updating part_ids, a sequence must also be provided."
+    assert "p2" not in sent
+
+
+def test_platemap_cache_concurrent_evict(tmp_path, monkeypatch):
+
+    cache = PlatemapCache(str(tmp_path))
+    list(cache.save("base", "order", "barcode", iter([["Plate", "Well"]])))
+
+    # Files removed by another thread while evicting are skipped
+    listdir = os.listdir
+
+    def removing_listdir(path):
+        names = listdir(path)
+        for name in names:
+            os.remove(os.path.join(path, name))
+        return names
+
+    monkeypatch.setattr(os, "listdir", removing_listdir)
+    cache.max_size = 0
+    cache.evict()
+
+
+def test_approximate_parts(tmp_path):
+
+    part = "ATGCGTACCTTGACGGATCCAAGTTCGAGCTAGGCTAAGC"
+    variant = part[:36] + "T" + part[37:]
+    sequence = "GGGG" + variant + "CCCC"
+
+    # A minimizer for each window of 10 k-mers, and the index finds the
+    # part with a substitution
+    positions = [position for position, hashed in minimizers(part)]
+    assert positions == sorted(set(positions)) and positions[-1] <= len(part) - 15
+    assert list(minimizers("N" * 40)) == []
+    index = KmerIndex([encode(part)])
+    assert index.search(encode(sequence), lambda i: PackedSequence(part)) == [(0, 4, 44)]
+    assert index.search(encode(sequence), lambda i: PackedSequence(part), max_mismatches=0) == []
+
+    loaded = KmerIndex.loads(index.dumps())
+    assert (loaded.k, loaded.w, loaded.keys, loaded.starts, loaded.ids, loaded.positions) == \
+        (index.k, index.w, index.keys, index.starts, index.ids, index.positions)
+    with pytest.raises(ValueError):
+        KmerIndex.loads(zlib.compress(b"not an index"))
+
+    client = _client({"part": part})
+    assert client._derive_parts(sequence, circular=False) == []
+    assert client._derive_parts(sequence, circular=False, identity=0.95) == [("part", ">", 4, 44)]
+
+    # The k-mer index is saved with the parts, and loaded by another client
+    client.cache_dir = str(tmp_path)
+    client._parts_index = None
+    client._get_parts_index(kmers=True)
+    saved = client._get_parts_store().get_blob('kmers', client._parts_index.base_fingerprint)
+    assert KmerIndex.loads(saved).keys == client._parts_index.kmers.keys
+
+    # A saved result is used without building the automaton or k-mers
+    assert client._derive_parts(sequence, circular=False, identity=0.95) == [("part", ">", 4, 44)]
+    client = _client({"part": part})
+    client.cache_dir = str(tmp_path)
+    assert client.derive_parts_batch([sequence], circular=False, identity=0.95) == \
+        [[("part", ">", 4, 44)]]
+    assert client._derive_parts(sequence, circular=False, identity=0.95) == [("part", ">", 4, 44)]
+    assert client._parts_index.automaton is None and client._parts_index.kmers is None
+
+
+class _Clock(object):
+    '''a stub for the time module, sleep advances monotonic time.
+    '''
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class _Response(object):
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.reason = ""
+
+    def close(self):
+        pass
+
+
+class _JsonResponse(_Response):
+
+    def __init__(self, status_code, body=None, headers=None):
+        super(_JsonResponse, self).__init__(status_code, headers)
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class _PartsSession(object):
+    '''a stub for the session of a client, serving a listing of parts and
+       the conditional check of the parts store (with an ETag).
+    '''
+    def __init__(self, parts, etag):
+        self.parts = parts
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        if "limit=1&" in url:
+            self.requests.append(("check", headers.get("If-None-Match")))
+            if headers.get("If-None-Match") == self.etag:
+                return _JsonResponse(304)
+            newest = sorted(self.parts, key=lambda x: x["time_updated"])[-1]
+            return _JsonResponse(200, {"count": len(self.parts), "results": [newest]},
+                                 {"ETag": self.etag})
+        self.requests.append(("list", None))
+        return _JsonResponse(200, {"count": len(self.parts), "next": None,
+                                   "results": [dict(part) for part in self.parts]})
+
+
+def test_parts_store(tmp_path, monkeypatch):
+
+    monkeypatch.delenv("FREEGENES_CACHE", raising=False)
+    monkeypatch.delenv("FREEGENES_OFFLINE", raising=False)
+    session = _PartsSession([{"uuid": "one", "optimized_sequence": "ATGAAACCC",
+                              "time_updated": "2019-10-01T00:00:00Z"}], etag='"v1"')
+
+    def cached_parts(**kwargs):
+        client = Client(token="test", validate=False, cache_dir=str(tmp_path), **kwargs)
+        client.session = session
+        client._cache_parts()
+        return client
+
+    # The parts are listed and saved to the store
+    client = cached_parts()
+    assert session.requests == [("list", None)]
+    assert client._get_parts_store().load() == {"one": session.parts[0]}
+    assert client._get_parts_store().get_meta("watermark") == "1|2019-10-01T00:00:00Z"
+
+    # Another client loads them after checking the count and newest time,
+    # and saves the ETag, which is then revalidated (304)
+    del session.requests[:]
+    assert sorted(cached_parts().cache['parts']) == ["one"]
+    assert sorted(cached_parts().cache['parts']) == ["one"]
+    assert session.requests == [("check", None), ("check", '"v1"')]
+
+    # A changed count (a new part) lists the parts again
+    del session.requests[:]
+    session.etag = '"v2"'
+    session.parts.append({"uuid": "two", "optimized_sequence": "GGGTTTTTT",
+                          "time_updated": "2019-10-01T00:00:00Z"})
+    assert sorted(cached_parts().cache['parts']) == ["one", "two"]
+    assert session.requests == [("check", '"v1"'), ("list", None)]
+    store = client._get_parts_store()
+    assert (store.get_meta("etag"), store.get_meta("watermark")) == ('"v2"', "2|2019-10-01T00:00:00Z")
+
+    # An offline client uses the store without a request
+    del session.requests[:]
+    assert sorted(cached_parts(offline=True).cache['parts']) == ["one", "two"]
+    assert session.requests == []
+
+
+def test_rate_limiter(monkeypatch):
+
+    clock = _Clock()
+    monkeypatch.setattr(session_module, "time", clock)
+
+    # A burst of rate requests, then one every 1 / rate seconds
+    limiter = session_module.RateLimiter(rate=2)
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == [0.5]
+
+    limiter.slow_down()
+    assert limiter.rate == 1.0
+    while limiter.rate != 2.0:
+        limiter.speed_up()
+
+    # Without a limit, slowing down starts from the recent rate, and the
+    # rate recovers to no limit
+    limiter = session_module.RateLimiter()
+    for _ in range(8):
+        limiter.acquire()
+    limiter.slow_down()
+    assert limiter.rate == 4.0
+    for _ in range(100):
+        limiter.speed_up()
+    assert limiter.rate is None
+
+
+def test_session_pool():
+
+    # Connections are pooled (and kept alive, unless keep_alive is False)
+    session = session_module.Session(pool_size=4, retries=2)
+    adapter = session.get_adapter("https://freegenes.dev/api/parts/")
+    assert session.get_adapter("http://freegenes.dev/") is adapter
+    assert adapter._pool_maxsize == 4 and adapter._pool_connections == 4
+    assert adapter.max_retries.total == 2 and adapter.max_retries.status == 0
+    assert session.headers["Connection"] == "keep-alive"
+    assert session_module.Session(keep_alive=False).headers["Connection"] == "close"
+
+    # The pool grows for more concurrency, and doesn't shrink
+    session.reserve(16)
+    assert session.get_adapter("https://freegenes.dev/")._pool_maxsize == 16
+    session.reserve(8)
+    assert session.pool_size == 16
+
+    # Bulk requests and mirrors reserve a connection per worker
+    client = Client(token="test", validate=False, workers=2)
+    assert client.session.pool_size == 10
+    client._run_bulk([(i, lambda: {}, ()) for i in range(3)], workers=12)
+    assert client.session.pool_size == 12
+
+
+def test_retries(monkeypatch):
+
+    date = email.utils.format_datetime(datetime.datetime.now(datetime.timezone.utc) +
+                                      datetime.timedelta(seconds=30), usegmt=True)
+    assert session_module.get_retry_after(_Response(503, {"Retry-After": "5"})) == 5
+    assert session_module.get_retry_after(_Response(503, {"Retry-After": "-1"})) == 0
+    assert 25 < session_module.get_retry_after(_Response(503, {"Retry-After": date})) <= 30
+    assert session_module.get_retry_after(_Response(503, {"Retry-After": "soon"})) is None
+    assert session_module.get_retry_after(_Response(503)) is None
+
+    # A request that isn't idempotent is only retried if it wasn't processed
+    session = session_module.Session(retries=2)
+    assert session._should_retry("GET", _Response(502), 0)
+    assert not session._should_retry("POST", _Response(502), 0)
+    assert session._should_retry("POST", _Response(503), 0)
+    assert session._should_retry("PATCH", _Response(429), 1)
+    assert not session._should_retry("GET", _Response(503), 2)
+    assert not session._should_retry("GET", _Response(404), 0)
+
+    clock = _Clock()
+    monkeypatch.setattr(session_module, "time", clock)
+    responses = [_Response(503, {"Retry-After": "3"}), _Response(200)]
+    monkeypatch.setattr(requests.Session, "request",
+                        lambda self, method, url, *args, **kwargs: responses.pop(0))
+    session = session_module.Session(retries=2)
+    assert session.get("https://freegenes.dev").status_code == 200
+    assert clock.sleeps == [3]
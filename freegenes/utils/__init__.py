@@ -6,7 +6,17 @@ from .fileio import (
     read_json
 )
 
-from .convert import str2csv
+from .automaton import Automaton
+from .convert import iter_csv, str2csv, write_csv
+
+from .nucleotide import (
+    PackedQuery,
+    PackedSequence,
+    decode,
+    encode,
+    is_nucleotide,
+    reverse_complement
+)
 
 from .terminal import (
     get_installdir,
@@ -0,0 +1,172 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+from array import array
+
+
+class Automaton(object):
+    '''An Aho-Corasick automaton to find all occurrences of many patterns
+       in a text with a single pass. Patterns are added with a value, and
+       once built, search yields (start, end, value) for every match
+       (including overlapping ones). Patterns and text can be strings or
+       any sequence of symbols (e.g., bytes of nucleotide codes).
+       The trie is stored in flat integer arrays (one row of len(alphabet)
+       transitions per node) so the automaton stays compact for large
+       numbers of long patterns.
+
+       Usage:
+       =====
+       automaton = Automaton()
+       automaton.add("ACGT", "part1")
+       automaton.build()
+       for start, end, value in automaton.search(sequence):
+           ...
+
+       To avoid holding all patterns in memory, an alphabet can be provided
+       and patterns passed to build as an iterable (e.g., a generator).
+
+       Parameters
+       ==========
+       alphabet: the symbols of the patterns (default derived from patterns)
+    '''
+    def __init__(self, alphabet=None):
+        self.patterns = []
+        self.symbols = alphabet
+        self.built = False
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, pattern, value):
+        '''add a pattern to the automaton, along with a value to return
+           when it is found. The automaton must be (re)built after adding.
+        '''
+        if pattern:
+            self.patterns.append((pattern, value))
+            self.built = False
+
+    def build(self, patterns=None):
+        '''build the trie and the failure links for the patterns that have
+           been added (or an iterable of (pattern, value) if provided).
+        '''
+        if patterns is None:
+            patterns = self.patterns
+
+        alphabet = self.symbols
+        if alphabet is None:
+            patterns = list(patterns)
+            alphabet = sorted(set().union(*[p for p, _ in patterns]))
+        self.alphabet = {letter: i for i, letter in enumerate(alphabet)}
+        width = max(len(alphabet), 1)
+        self.width = width
+
+        # Symbols that are already offsets (e.g., nucleotide codes)
+        offsets = all(letter == i for letter, i in self.alphabet.items())
+
+        # Node 0 is the root, a transition of 0 means "no edge" in the trie.
+        # For each node we keep the parent and offset of the edge to it, and
+        # the nodes at each depth (to compute failure links by depth)
+        delta = array('i', [0] * width)
+        parent = array('i', [0])
+        edge = array('i', [0])
+        levels = []
+        terminal = {}
+
+        for pattern, value in patterns:
+            if not pattern:
+                continue
+            if not offsets:
+                pattern = [self.alphabet[letter] for letter in pattern]
+
+            # Follow the existing trie as far as possible
+            node = 0
+            depth = 0
+            for offset in pattern:
+                child = delta[node * width + offset]
+                if not child:
+                    break
+                node = child
+                depth += 1
+
+            # The rest of the pattern is a new chain of nodes
+            remaining = len(pattern) - depth
+            if remaining:
+                first = len(parent)
+                delta.extend(array('i', [0]) * (width * remaining))
+                parent.append(node)
+                parent.extend(range(first, first + remaining - 1))
+                edge.extend(pattern[depth:])
+                while len(levels) < len(pattern):
+                    levels.append(array('i'))
+                for new in range(first, first + remaining):
+                    delta[node * width + pattern[depth]] = new
+                    levels[depth].append(new)
+                    node = new
+                    depth += 1
+
+            terminal.setdefault(node, []).append((value, len(pattern)))
+
+        nodes = len(parent)
+        fail = array('i', [0]) * nodes
+        link = array('i', [0]) * nodes
+
+        # Nodes at depth 1 fail to the root, deeper nodes to the longest
+        # suffix in the trie, found from the failure link of the parent
+        for level in levels[1:]:
+            for node in level:
+                offset = edge[node]
+                target = fail[parent[node]]
+                while True:
+                    child = delta[target * width + offset]
+                    if child or not target:
+                        break
+                    target = fail[target]
+                fail[node] = child
+                link[node] = child if child in terminal else link[child]
+
+        self.delta = delta
+        self.fail = fail
+        self.link = link
+        self.terminal = terminal
+        self.built = True
+
+    def search(self, text):
+        '''search a text for all patterns, yielding (start, end, value)
+           for each match, ordered by the end position.
+        '''
+        if not self.built:
+            self.build()
+
+        alphabet = self.alphabet
+        delta = self.delta
+        width = self.width
+        fail = self.fail
+        link = self.link
+        terminal = self.terminal
+        node = 0
+
+        for end, letter in enumerate(text, 1):
+            offset = alphabet.get(letter)
+            if offset is None:
+                node = 0
+                continue
+
+            while True:
+                child = delta[node * width + offset]
+                if child or not node:
+                    break
+                node = fail[node]
+            node = child
+
+            match = node if node in terminal else link[node]
+            while match:
+                for value, length in terminal[match]:
+                    yield (end - length, end, value)
+                match = link[match]
@@ -17,10 +17,37 @@ def str2csv(string, newline="\n", delim=","):
     '''given a string with csv content, read in as csv and return rows,
        with the header in the first row.
     '''
-    rows = []
-    reader = csv.reader(string.split(newline), delimiter=delim)
-    for row in reader:
-        if row:
-            rows.append(row)
-    return rows
+    return list(iter_csv(string.split(newline), delim=delim))
 
+
+def iter_csv(lines, delim=",", output=None):
+    '''given an iterable of lines with csv content (e.g., streamed from a
+       response), yield the rows as they are read, skipping empty rows.
+       If an output file is provided, the lines are also written to it.
+    '''
+    if output is None:
+        for row in csv.reader(lines, delimiter=delim):
+            if row:
+                yield row
+        return
+
+    with open(output, 'w') as filey:
+
+        def write_through(lines):
+            for line in lines:
+                filey.write(line + "\n")
+                yield line
+
+        for row in csv.reader(write_through(lines), delimiter=delim):
+            if row:
+                yield row
+
+
+def write_csv(rows, output, delim=","):
+    '''yield rows while writing them (as csv) to an output file.
+    '''
+    with open(output, 'w') as filey:
+        writer = csv.writer(filey, delimiter=delim, lineterminator="\n")
+        for row in rows:
+            writer.writerow(row)
+            yield row
@@ -0,0 +1,159 @@
+'''
+
+Copyright (C) 2019 Vanessa Sochat.
+
+This Source Code Form is subject to the terms of the
+Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+
+# Nucleotides are encoded as 2-bit codes, A=0, C=1, G=2, T=3, so the
+# complement of a code is 3 - code. Any other letter is encoded as 4.
+
+NUCLEOTIDES = "ACGT"
+INVALID = 4
+
+_ENCODE = bytearray([INVALID] * 256)
+for _code, _letter in enumerate(NUCLEOTIDES):
+    _ENCODE[ord(_letter)] = _code
+    _ENCODE[ord(_letter.lower())] = _code
+_ENCODE = bytes(_ENCODE)
+
+_DECODE = bytes(bytearray(ord(x) for x in NUCLEOTIDES)) + b"N" * 252
+
+# Complements for strings, including ambiguous (IUPAC) letters
+_COMPLEMENT_LETTERS = str.maketrans("ACGTRYKMBVDHNSWacgtrykmbvdhnsw",
+                                    "TGCAYRMKVBHDNSWtgcayrmkvbhdnsw")
+_COMPLEMENT = bytes(bytearray([3, 2, 1, 0] + [INVALID] * 252))
+
+# Letters that aren't nucleotides, as codes 0 (in a packed query) or 1
+_VALID_CODES = bytes(bytearray([0, 1, 2, 3] + [0] * 252))
+_INVALID_CODES = bytes(bytearray([0, 0, 0, 0] + [1] * 252))
+
+# Each byte of a packed sequence unpacks to four codes
+_UNPACK = [bytes(bytearray([(byte >> shift) & 3 for shift in (0, 2, 4, 6)]))
+           for byte in range(256)]
+
+
+def encode(sequence):
+    '''encode a sequence (string) as bytes of nucleotide codes, one per
+       letter. Letters that are not nucleotides are encoded as INVALID.
+    '''
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii', 'replace')
+    return sequence.translate(_ENCODE)
+
+
+def decode(codes):
+    '''decode bytes of nucleotide codes to a sequence (string).
+    '''
+    return codes.translate(_DECODE).decode('ascii')
+
+
+def is_nucleotide(sequence):
+    '''determine if a sequence only has (unambiguous) nucleotides.
+    '''
+    return INVALID not in encode(sequence)
+
+
+def pack_codes(codes):
+    '''pack nucleotide codes (at most 3) as an integer, 2 bits per base
+       with the first base in the lowest bits.
+    '''
+    # Codes are at most 3, so shifting every fourth code (as one integer)
+    # sets the bits of the bytes without carrying over to the next
+    packed = 0
+    for shift in range(4):
+        packed |= int.from_bytes(bytes(codes[shift::4]), 'little') << (2 * shift)
+    return packed
+
+
+def reverse_complement(sequence):
+    '''return the reverse complement of a sequence (string), ambiguous
+       letters (e.g., R for A or G) are complemented, others are kept.
+    '''
+    return sequence.translate(_COMPLEMENT_LETTERS)[::-1]
+
+
+class PackedSequence(object):
+    '''A nucleotide sequence packed with 2 bits per base (four bases per
+       byte), a quarter of the memory of a string. The sequence must only
+       have nucleotides (see is_nucleotide).
+
+       Usage:
+       =====
+       packed = PackedSequence("ATGGCT")
+       str(packed.reverse_complement())  # AGCCAT
+    '''
+    __slots__ = ('data', 'length')
+
+    def __init__(self, sequence=None, codes=None):
+        if codes is None:
+            codes = encode(sequence or "")
+        if INVALID in codes:
+            raise ValueError("A packed sequence can only have A, C, G, and T.")
+
+        self.length = len(codes)
+        self.data = pack_codes(codes).to_bytes((self.length + 3) // 4, 'little')
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return decode(self.codes())
+
+    def __repr__(self):
+        return "[packed][%s]" % self.length
+
+    def __eq__(self, other):
+        return (isinstance(other, PackedSequence) and
+                self.length == other.length and self.data == other.data)
+
+    def __hash__(self):
+        return hash((self.length, self.data))
+
+    def codes(self):
+        '''return the unpacked sequence, as bytes of nucleotide codes.
+        '''
+        return b"".join(_UNPACK[byte] for byte in self.data)[:self.length]
+
+    def reverse_complement(self):
+        '''return the reverse complement, as a new packed sequence.
+        '''
+        return PackedSequence(codes=self.codes()[::-1].translate(_COMPLEMENT))
+
+
+class PackedQuery(object):
+    '''A query sequence (nucleotide codes, with any letters) packed as
+       integers, to count the mismatches of packed sequences aligned to it
+       without unpacking them. Letters that aren't nucleotides (e.g., N)
+       are always mismatches.
+
+       Usage:
+       =====
+       query = PackedQuery(encode("GGATGGCTN"))
+       query.count_mismatches(PackedSequence("ATGGCT"), 2)  # 0
+    '''
+    __slots__ = ('value', 'invalid', 'length')
+
+    def __init__(self, codes):
+        self.length = len(codes)
+        self.value = pack_codes(codes.translate(_VALID_CODES))
+        self.invalid = pack_codes(codes.translate(_INVALID_CODES))
+
+    def __len__(self):
+        return self.length
+
+    def count_mismatches(self, sequence, start):
+        '''count the mismatches of a packed sequence aligned at start.
+        '''
+        bits = 2 * len(sequence)
+        mask = (1 << bits) - 1
+        window = (self.value >> (2 * start)) & mask
+        different = int.from_bytes(sequence.data, 'little') ^ window
+
+        # One (low) bit for each base that differs (or isn't a nucleotide)
+        different = (different | (different >> 1)) & (mask // 3)
+        different |= (self.invalid >> (2 * start)) & mask
+        return bin(different).count("1")
@@ -5,7 +5,7 @@
 # Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-__version__ = "0.0.16"
+__version__ = "0.0.41"
 AUTHOR = 'Vanessa Sochat'
 AUTHOR_EMAIL = 'vsochat@stanford.edu'
 NAME = 'freegenes'
@@ -19,6 +19,10 @@ INSTALL_REQUIRES = (
     ('requests', {'min_version': '2.21.0'}),
 )
 
+INSTALL_REQUIRES_ASYNC = (
+    ('aiohttp', {'min_version': '3.5.0'}),
+)
+
 TESTS_REQUIRES = (
     ('pytest', {'min_version': '4.6.2'}),
 )
@@ -26,7 +26,7 @@ def get_lookup():
         exec(filey.read(), lookup)
     return lookup
 
-def get_requirements(lookup=None):
+def get_requirements(lookup=None, key='INSTALL_REQUIRES'):
     '''get_requirements reads in requirements and versions from
        the lookup obtained with get_lookup'''
 
@@ -34,7 +34,7 @@ def get_requirements(lookup=None):
         lookup = get_lookup()
 
     install_requires = []
-    for module in lookup['INSTALL_REQUIRES']:
+    for module in lookup[key]:
         module_name = module[0]
         module_meta = module[1]
         if "exact_version" in module_meta:
@@ -75,6 +75,7 @@ if __name__ == "__main__":
 
     INSTALL_REQUIRES = get_requirements(lookup)
     TESTS_REQUIRES = get_requirements(lookup)
+    INSTALL_REQUIRES_ASYNC = get_requirements(lookup, 'INSTALL_REQUIRES_ASYNC')
 
     setup(name=NAME,
           version=VERSION,
@@ -94,6 +95,7 @@ if __name__ == "__main__":
           setup_requires=["pytest-runner"],
           tests_require=TESTS_REQUIRES,
           install_requires=INSTALL_REQUIRES,
+          extras_require={'async': INSTALL_REQUIRES_ASYNC},
           classifiers=[
               'Intended Audience :: Science/Research',
               'Intended Audience :: Developers',